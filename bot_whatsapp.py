@@ -5,13 +5,25 @@ import uuid
 from datetime import datetime
 import re
 import logging
-from functools import lru_cache
+from functools import lru_cache, partial
+from collections import OrderedDict, defaultdict, deque
+import copy
+import hashlib
+import heapq
+from typing import NamedTuple, Optional
 import time
+import threading
+import queue
+import random
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import traceback
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.twiml.messaging_response import MessagingResponse
 from qr_automation import PlanOutAutomation
 
 # Configuración de logging optimizada para Google Cloud Run
@@ -134,9 +146,168 @@ def verify_secrets_and_environment():
     return len(missing_secrets) == 0
 logger = logging.getLogger(__name__)
 
+# Serialización JSON con orjson (implementado en C) si está instalado
+ORJSON_AVAILABLE = False
+try:
+    import orjson
+    from flask.json.provider import JSONProvider
+
+    class OrjsonProvider(JSONProvider):
+        """ Proveedor JSON de Flask respaldado por orjson, usado por jsonify y request.get_json """
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    logger.warning("Módulo orjson no está instalado. Se usará el serializador JSON estándar de Flask.")
+
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
+
+# Estado de conversación en Redis (opcional): sobrevive reinicios. Sigue haciendo falta un solo
+# proceso de gunicorn: _user_queues y _seen_message_sids son por proceso.
+REDIS_AVAILABLE = False
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    logger.info("Módulo redis no está instalado. El estado de los usuarios se guardará en memoria.")
+
+REDIS_URL = os.environ.get('REDIS_URL')
+USER_STATE_TTL = int(os.environ.get('USER_STATE_TTL', '3600'))  # segundos; las conversaciones inactivas vencen solas
+
+class UserStateStore:
+    """
+    Estado de conversación por teléfono con la interfaz de dict que usa la máquina de estados
+    (get y asignación por clave). Con REDIS_URL se guarda como JSON en 'wa:state:<teléfono>' con
+    TTL; sin Redis se usa un dict en memoria del proceso, como antes.
+    Si una escritura en Redis falla, el estado queda en memoria y tiene prioridad en las lecturas
+    hasta que una escritura posterior en Redis funcione.
+    El estado leído de Redis es una copia: los cambios se persisten reasignando user_states[phone].
+    """
+    KEY_PREFIX = "wa:state:"
+
+    def __init__(self, redis_url=None, ttl=USER_STATE_TTL):
+        self._local = {}
+        self._ttl = ttl
+        self._redis = None
+        if redis_url and REDIS_AVAILABLE:
+            try:
+                self._redis = redis.Redis.from_url(redis_url, socket_timeout=2, socket_connect_timeout=2,
+                                                   decode_responses=True)
+                self._redis.ping()
+                logger.info("Estado de usuarios en Redis.")
+            except Exception as e:
+                logger.error(f"No se pudo conectar a Redis ({e}). El estado de los usuarios se guardará en memoria.")
+                self._redis = None
+        elif redis_url:
+            logger.warning("REDIS_URL está configurado pero el módulo redis no está instalado. Estado en memoria.")
+
+    def get(self, phone_number, default=None):
+        local_state = self._local.get(phone_number)
+        if local_state is not None:
+            return local_state
+        if self._redis is not None:
+            try:
+                raw = self._redis.get(self.KEY_PREFIX + phone_number)
+                return json.loads(raw) if raw is not None else default
+            except redis.RedisError as e:
+                logger.error(f"Error leyendo estado de {phone_number} en Redis: {e}.")
+        return default
+
+    def __getitem__(self, phone_number):
+        state = self.get(phone_number)
+        if state is None:
+            raise KeyError(phone_number)
+        return state
+
+    def __setitem__(self, phone_number, state):
+        if self._redis is not None:
+            try:
+                self._redis.set(self.KEY_PREFIX + phone_number, json.dumps(state), ex=self._ttl)
+                # Ya está en Redis: descartar un estado en memoria de un fallo anterior
+                self._local.pop(phone_number, None)
+                return
+            except redis.RedisError as e:
+                logger.error(f"Error guardando estado de {phone_number} en Redis: {e}. Usando memoria.")
+        self._local[phone_number] = state
+
+    def __contains__(self, phone_number):
+        return self.get(phone_number) is not None
+
+user_states = UserStateStore(REDIS_URL)
+
+# Procesamiento del webhook en segundo plano (ver whatsapp_reply)
+_webhook_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="webhook")
+# Si el mensaje se procesa dentro de este plazo la respuesta viaja como TwiML en el cuerpo del webhook
+# (sin llamada REST a Twilio); si no, se envía por REST al terminar. Twilio corta el webhook a los 15 s.
+WEBHOOK_TWIML_DEADLINE = float(os.environ.get('WEBHOOK_TWIML_DEADLINE', '5'))  # segundos
+# Cola FIFO por usuario: sus mensajes se procesan de a uno y en orden de llegada. Los que esperan
+# no ocupan un hilo del pool; un solo drenado por usuario los va tomando.
+_user_queues = {}  # teléfono -> {'pending': deque de (tarea, Future), 'draining': bool}
+_user_queues_guard = threading.Lock()
+
+def _enqueue_user_message(phone_number, task):
+    """ Encola la tarea del usuario y lanza su drenado si no hay uno en curso. Devuelve el Future de la tarea """
+    future = Future()
+    with _user_queues_guard:
+        user_queue = _user_queues.get(phone_number)
+        if user_queue is None:
+            user_queue = _user_queues[phone_number] = {'pending': deque(), 'draining': False}
+        user_queue['pending'].append((task, future))
+        start_drain = not user_queue['draining']
+        user_queue['draining'] = True
+    if start_drain:
+        _webhook_executor.submit(_drain_user_queue, phone_number)
+    return future
+
+def _drain_user_queue(phone_number):
+    """ Ejecuta en orden las tareas pendientes del usuario hasta vaciar su cola """
+    while True:
+        with _user_queues_guard:
+            user_queue = _user_queues[phone_number]
+            if not user_queue['pending']:
+                del _user_queues[phone_number]
+                return
+            task, future = user_queue['pending'].popleft()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(task())
+        except Exception as e:
+            future.set_exception(e)
+
+# MessageSid ya recibidos: si Twilio reintenta un webhook (timeout/5xx) el mensaje no vuelve a
+# pasar por la máquina de estados. LRU con TTL, en memoria del proceso como user_states.
+MESSAGE_SID_TTL = 24 * 60 * 60  # segundos
+MESSAGE_SID_CACHE_MAX = 50000
+_seen_message_sids = OrderedDict()  # MessageSid -> timestamp de recepción
+_seen_message_sids_lock = threading.Lock()
+
+def _mark_message_seen(message_sid):
+    """ Registra el MessageSid. Devuelve False si ya se había recibido dentro del TTL (reintento de Twilio) """
+    now = time.time()
+    with _seen_message_sids_lock:
+        seen_at = _seen_message_sids.get(message_sid)
+        if seen_at is not None and now - seen_at < MESSAGE_SID_TTL:
+            return False
+        _seen_message_sids[message_sid] = now
+        _seen_message_sids.move_to_end(message_sid)
+        # Descartar los más viejos: por tamaño o por TTL vencido
+        while _seen_message_sids and (len(_seen_message_sids) > MESSAGE_SID_CACHE_MAX
+                                      or now - next(iter(_seen_message_sids.values())) >= MESSAGE_SID_TTL):
+            _seen_message_sids.popitem(last=False)
+        return True
 
-user_states = {}
+def _forget_message_sid(message_sid):
+    """ Olvida el MessageSid para que el reintento de Twilio sí se procese (el webhook falló con 5xx) """
+    with _seen_message_sids_lock:
+        _seen_message_sids.pop(message_sid, None)
 
 # Verificar secretos al inicio del bot
 verify_secrets_and_environment()
@@ -153,6 +324,59 @@ TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
 TWILIO_WHATSAPP_NUMBER = os.environ.get('TWILIO_WHATSAPP_NUMBER')
 
+class TokenBucket:
+    """
+    Limitador de tasa (token bucket) seguro entre hilos: `rate` tokens por segundo,
+    con ráfagas de hasta `capacity`.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Toma un token, esperando lo necesario si el bucket está vacío """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Límite de envíos salientes por debajo del tope de Twilio para WhatsApp (25 mensajes/segundo)
+_twilio_bucket = TokenBucket(rate=20, capacity=25)
+
+# Cliente Twilio compartido: se crea una sola vez y reutiliza su requests.Session (keep-alive)
+_twilio_client = None
+_twilio_client_lock = threading.Lock()
+# Conexiones keep-alive a api.twilio.com. El pool por defecto de TwilioHttpClient es cpu_count + 4
+# (5 en Cloud Run con 1 CPU): con los workers del webhook y los broadcasts en paralelo se descartaban
+# conexiones y cada envío volvía a pagar el handshake TLS.
+TWILIO_POOL_MAXSIZE = 20
+TWILIO_HTTP_TIMEOUT = 15  # segundos
+# Difusión: envíos en paralelo sobre el mismo pool de conexiones, con un ritmo máximo global
+# (antes era uno por vez con 1 s de pausa). BROADCAST_CONCURRENCY no debería superar TWILIO_POOL_MAXSIZE.
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '5'))
+BROADCAST_MAX_PER_SECOND = float(os.environ.get('BROADCAST_MAX_PER_SECOND', '5'))
+
+def get_twilio_client():
+    """ Devuelve el cliente Twilio compartido, creándolo en el primer uso """
+    global _twilio_client
+    if _twilio_client is None:
+        with _twilio_client_lock:
+            if _twilio_client is None:
+                http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_HTTP_TIMEOUT)
+                http_client.session.mount("https://", HTTPAdapter(pool_connections=10,
+                                                                  pool_maxsize=TWILIO_POOL_MAXSIZE))
+                _twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
+    return _twilio_client
+
 def split_long_message(message, max_length=1500):
     """
     Divide un mensaje largo en partes más pequeñas respetando el límite de caracteres.
@@ -194,8 +418,86 @@ def split_long_message(message, max_length=1500):
     
     return parts
 
+def _numbered_message_parts(message):
+    """ Divide un mensaje largo y numera las partes si hay más de una """
+    message_parts = split_long_message(message)
+    if len(message_parts) == 1:
+        return message_parts
+    return [f"({i+1}/{len(message_parts)})\n{part}" for i, part in enumerate(message_parts)]
+
+
+class TwimlReplyCollector:
+    """
+    Junta las respuestas al remitente de un webhook para devolverlas como TwiML.
+    Si el webhook deja de esperar (cierra el colector antes de que termine el procesamiento),
+    lo acumulado y lo que siga se envía por la API REST desde el hilo que procesa el mensaje,
+    así los mensajes conservan su orden.
+    """
+    def __init__(self, phone_number):
+        self.phone_number = normalize_phone(phone_number)
+        self._messages = []
+        self._open = True
+        self._done = False
+        self._lock = threading.Lock()
+
+    def offer(self, phone_number, message):
+        """
+        Guarda el mensaje si sigue abierto y va al remitente.
+        Devuelve (guardado, pendientes_a_enviar_por_REST).
+        """
+        with self._lock:
+            if normalize_phone(phone_number) != self.phone_number:
+                return False, []
+            if self._open:
+                self._messages.append(message)
+                return True, []
+            pending, self._messages = self._messages, []
+            return False, pending
+
+    def finish(self):
+        """ Marca el procesamiento como terminado; devuelve lo que quedó sin entregar si el webhook ya no espera """
+        with self._lock:
+            self._done = True
+            if self._open:
+                return []
+            pending, self._messages = self._messages, []
+            return pending
+
+    def close(self):
+        """ Lo llama el webhook al dejar de esperar: devuelve los mensajes para TwiML si el procesamiento terminó """
+        with self._lock:
+            self._open = False
+            if not self._done:
+                return []
+            messages, self._messages = self._messages, []
+            return messages
+
+    def to_twiml(self, messages):
+        resp = MessagingResponse()
+        for message in messages:
+            for part in _numbered_message_parts(message):
+                resp.message(part)
+        return str(resp)
+
+# Colector TwiML del hilo actual (lo fija el worker del webhook mientras procesa un mensaje)
+_twiml_local = threading.local()
+
 def send_twilio_message(phone_number, message):
-    """ Envía un mensaje de WhatsApp usando Twilio, dividiendo mensajes largos """
+    """
+    Envía un mensaje de WhatsApp. Dentro del procesamiento de un webhook la respuesta al remitente
+    se devuelve como TwiML; en otro caso (o si el webhook ya respondió) se usa la API REST
+    """
+    collector = getattr(_twiml_local, 'collector', None)
+    if collector is not None:
+        buffered, pending = collector.offer(phone_number, message)
+        if buffered:
+            return True
+        for earlier_message in pending:
+            _send_twilio_rest(phone_number, earlier_message)
+    return _send_twilio_rest(phone_number, message)
+
+def _send_twilio_rest(phone_number, message):
+    """ Envía un mensaje de WhatsApp usando la API REST de Twilio, dividiendo mensajes largos """
     # Asegurarse que el número tenga el prefijo 'whatsapp:'
     if not phone_number.startswith('whatsapp:'):
         destination_number = f"whatsapp:{phone_number}"
@@ -216,18 +518,14 @@ def send_twilio_message(phone_number, message):
             logger.error("Credenciales de Twilio (SID o Token) no configuradas.")
             return False
 
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        client = get_twilio_client()
         
-        # Dividir mensaje si es muy largo
-        message_parts = split_long_message(message)
+        # Dividir mensaje si es muy largo (partes numeradas)
+        message_parts = _numbered_message_parts(message)
         
         success = True
         for i, part in enumerate(message_parts):
-            # Si hay múltiples partes, agregar numeración
-            if len(message_parts) > 1:
-                part_header = f"({i+1}/{len(message_parts)})\n"
-                part = part_header + part
-            
+            _twilio_bucket.acquire()
             twilio_message = client.messages.create(
                 from_=origin_number,
                 body=part,
@@ -289,6 +587,107 @@ def clear_background_color_for_new_rows(sheet, num_new_rows):
     except Exception as e:
         logger.error(f"Error al limpiar color de fondo de filas nuevas: {e}")
 
+class SheetsWriteQueue:
+    """
+    Cola de escrituras a Google Sheets: junta los append_rows de solicitudes concurrentes
+    dirigidos a la misma hoja y los envía en una sola llamada a la API.
+    """
+    FLUSH_INTERVAL = 0.25  # segundos que se espera para juntar más filas antes de escribir
+    MAX_BATCH_ROWS = 100   # se escribe en cuanto se acumulan estas filas
+    MAX_RETRIES = 3        # reintentos ante límite de cuota (HTTP 429)
+    RESULT_TIMEOUT = 60    # segundos que el llamador espera a que su escritura empiece o termine
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def append_rows(self, sheet, rows):
+        """ Encola filas para la hoja. Devuelve un Future que se resuelve con la cantidad de filas escritas """
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((sheet, rows, future))
+        return future
+
+    def write_rows(self, sheet, rows):
+        """
+        Encola filas y espera el resultado. Si la escritura no empezó dentro de RESULT_TIMEOUT
+        se cancela (no se escribirá después) y se lanza TimeoutError.
+        """
+        future = self.append_rows(sheet, rows)
+        try:
+            return future.result(timeout=self.RESULT_TIMEOUT)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+            # Ya se está escribiendo: el timeout del cliente de gspread acota la espera
+            return future.result()
+
+    def _ensure_worker(self):
+        # El hilo se crea en el primer uso (y dentro de cada worker de gunicorn, no antes del fork)
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="sheets-write-queue", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            row_count = len(batch[0][1])
+            deadline = time.time() + self.FLUSH_INTERVAL
+            while row_count < self.MAX_BATCH_ROWS:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                row_count += len(item[1])
+            self._flush(batch)
+
+    def _flush(self, batch):
+        # Agrupar por hoja respetando el orden de llegada
+        by_sheet = {}
+        for sheet, rows, future in batch:
+            # El llamador ya se rindió y canceló: esas filas no se escriben
+            if not future.set_running_or_notify_cancel():
+                continue
+            by_sheet.setdefault(sheet.id, (sheet, []))[1].append((rows, future))
+
+        for sheet, entries in by_sheet.values():
+            all_rows = [row for rows, _ in entries for row in rows]
+            try:
+                self._append_with_retry(sheet, all_rows)
+            except Exception as e:
+                logger.error(f"Error escribiendo {len(all_rows)} filas en hoja '{sheet.title}': {e}")
+                for _, future in entries:
+                    future.set_exception(e)
+                continue
+
+            # Limpiar colores de fondo de las filas recién agregadas (una vez por lote)
+            clear_background_color_for_new_rows(sheet, len(all_rows))
+            if len(entries) > 1:
+                logger.info(f"Agrupadas {len(entries)} escrituras ({len(all_rows)} filas) en un solo append_rows en '{sheet.title}'.")
+            for rows, future in entries:
+                future.set_result(len(rows))
+
+    def _append_with_retry(self, sheet, rows):
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                return sheet.append_rows(rows, value_input_option='USER_ENTERED')
+            except gspread.exceptions.APIError as e:
+                if getattr(e, 'code', None) != 429 or attempt == self.MAX_RETRIES - 1:
+                    raise
+                # Backoff exponencial con jitter para no reintentar todos a la vez
+                delay = (2 ** attempt) + random.uniform(0, 1)
+                logger.warning(f"Cuota de Google Sheets excedida, reintentando en {delay:.1f}s...")
+                time.sleep(delay)
+
+sheets_write_queue = SheetsWriteQueue()
+SHEETS_HTTP_TIMEOUT = 30  # segundos por request a la API de Google Sheets
+
 def send_templated_message(phone_number, content_sid, content_variables=None):
     """ Envía un mensaje de WhatsApp usando una plantilla de Twilio """
     # Asegurarse que el número tenga el prefijo 'whatsapp:+'
@@ -312,7 +711,7 @@ def send_templated_message(phone_number, content_sid, content_variables=None):
             logger.error("Credenciales de Twilio (SID o Token) no configuradas.")
             return {"success": False, "error": "Twilio credentials not configured"}
 
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+        client = get_twilio_client()
 
         message_data = {
             'from_': origin_number,
@@ -324,6 +723,7 @@ def send_templated_message(phone_number, content_sid, content_variables=None):
             # Twilio espera las variables como un string JSON
             message_data['content_variables'] = json.dumps(content_variables)
 
+        _twilio_bucket.acquire()
         twilio_message = client.messages.create(**message_data)
         logger.info(f"Mensaje de plantilla {content_sid} enviado a {destination_number}: {twilio_message.sid}")
         return {"success": True, "sid": twilio_message.sid}
@@ -335,9 +735,65 @@ def send_templated_message(phone_number, content_sid, content_variables=None):
             error_details = e.msg
         return {"success": False, "error": error_details}
 
+# Géneros ya inferidos por OpenAI, por nombre en minúsculas. infer_genders_llm los completa en lote
+# para toda una lista, así infer_gender_llm no hace una llamada por invitado.
+_gender_llm_cache = {}
+GENDER_LLM_CACHE_MAX = 4096
+GENDER_LLM_SYSTEM_PROMPT = "Eres un asistente experto en nombres hispanohablantes, especialmente de Argentina. Tu tarea es determinar el género más probable (Hombre o Mujer) asociado a un nombre de pila. Responde únicamente con una de estas tres palabras: Hombre, Mujer, Desconocido."
+
+def _store_gender_llm(name_key, gender):
+    if len(_gender_llm_cache) >= GENDER_LLM_CACHE_MAX:
+        _gender_llm_cache.clear()
+    _gender_llm_cache[name_key] = gender
+
+def infer_genders_llm(first_names):
+    """
+    Infiere con una sola llamada a OpenAI el género de varios nombres de pila y guarda el resultado
+    en la caché que consulta infer_gender_llm. Los nombres que resuelve _guess_gender_offline no se consultan.
+
+    Args:
+        first_names (iterable): Nombres de pila a analizar.
+
+    Returns:
+        dict: {nombre: "Hombre" | "Mujer" | "Desconocido"} para los nombres pedidos.
+    """
+    names = {name.strip().casefold(): name.strip() for name in first_names if isinstance(name, str) and name.strip()}
+    offline = {}
+    for key, name in names.items():
+        guessed = _guess_gender_offline(name)
+        if guessed:
+            offline[key] = GENDER_LABEL_TO_LLM[guessed]
+    pending = [name for key, name in names.items() if key not in offline and key not in _gender_llm_cache]
+
+    if pending and OPENAI_AVAILABLE and client is not None:
+        try:
+            logger.debug(f"Consultando OpenAI para género de {len(pending)} nombres en lote")
+            user_prompt = ("Nombres de pila:\n" + "\n".join(pending) +
+                           '\n\nResponde con un objeto JSON {"nombre": "Hombre" | "Mujer" | "Desconocido"} '
+                           "con una entrada por cada nombre, escrito tal como aparece.")
+            _openai_bucket.acquire()
+            response = client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": GENDER_LLM_SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ],
+                response_format={"type": "json_object"},
+                temperature=0
+            )
+            result = json.loads(response.choices[0].message.content)
+            for name, gender in result.items():
+                gender = str(gender).strip().capitalize()
+                _store_gender_llm(str(name).strip().casefold(), gender if gender in ("Hombre", "Mujer") else "Desconocido")
+        except Exception as e:
+            logger.error(f"Error al llamar a OpenAI para inferir género en lote: {e}")
+
+    return {name: offline.get(key) or _gender_llm_cache.get(key, "Desconocido") for key, name in names.items()}
+
 def infer_gender_llm(first_name):
     """
-    Usa OpenAI (LLM) para inferir el género de un primer nombre.
+    Usa OpenAI (LLM) para inferir el género de un primer nombre. Los nombres que resuelve
+    _guess_gender_offline no llegan a OpenAI.
 
     Args:
         first_name (str): El primer nombre a analizar.
@@ -348,6 +804,16 @@ def infer_gender_llm(first_name):
     if not first_name or not isinstance(first_name, str):
         return "Desconocido"
 
+    guessed = _guess_gender_offline(first_name)
+    if guessed:
+        return GENDER_LABEL_TO_LLM[guessed]
+
+    # Resultado ya obtenido (p. ej. por infer_genders_llm para toda la lista)
+    name_key = first_name.strip().casefold()
+    cached = _gender_llm_cache.get(name_key)
+    if cached is not None:
+        return cached
+
     # Verificar si el cliente OpenAI está disponible
     if not OPENAI_AVAILABLE or client is None:
         logger.warning("OpenAI no disponible para inferir género. Devolviendo 'Desconocido'.")
@@ -355,9 +821,10 @@ def infer_gender_llm(first_name):
 
     try:
         logger.debug(f"Consultando OpenAI para género de: {first_name}")
-        system_prompt = "Eres un asistente experto en nombres hispanohablantes, especialmente de Argentina. Tu tarea es determinar el género más probable (Hombre o Mujer) asociado a un nombre de pila. Responde únicamente con una de estas tres palabras: Hombre, Mujer, Desconocido."
+        system_prompt = GENDER_LLM_SYSTEM_PROMPT
         user_prompt = f"Nombre de pila: {first_name}"
 
+        _openai_bucket.acquire()
         response = client.chat.completions.create(
             model="gpt-3.5-turbo", # Puedes probar con "gpt-4o" o "gpt-4" si necesitas más precisión
             messages=[
@@ -373,6 +840,7 @@ def infer_gender_llm(first_name):
 
         # Validar la respuesta
         if result_text in ["Hombre", "Mujer"]:
+            _store_gender_llm(name_key, result_text)
             return result_text
         else:
             # Si responde algo inesperado, lo marcamos como desconocido
@@ -397,6 +865,10 @@ def get_or_create_unified_event_sheet(sheet_conn, event_name):
     """
     try:
         unified_sheet_name = event_name  # Usar directamente el nombre del evento
+        # Hoja ya abierta y verificada hace poco: sin worksheet() ni revisión de encabezados
+        unified_event_sheet = sheet_conn.get_verified_sheet(unified_sheet_name)
+        if unified_event_sheet is not None:
+            return unified_event_sheet
         logger.info(f"Intentando obtener/crear hoja unificada: '{unified_sheet_name}'")
         
         # Intentar obtener la hoja existente
@@ -407,7 +879,7 @@ def get_or_create_unified_event_sheet(sheet_conn, event_name):
             # Verificar si la hoja existente tiene las columnas correctas
             expected_headers = ['Nombre', 'Email', 'Instagram', 'TIPO', 'PR', 'EMAIL PR', 'Timestamp', 'Enviado']
             try:
-                headers = unified_event_sheet.row_values(1)
+                headers = sheet_conn.get_headers(unified_event_sheet)
                 if len(headers) < len(expected_headers) or headers[:len(expected_headers)] != expected_headers:
                     logger.info(f"Actualizando hoja existente '{unified_sheet_name}' para incluir columna Enviado...")
                     # Expandir la hoja si es necesario
@@ -416,7 +888,9 @@ def get_or_create_unified_event_sheet(sheet_conn, event_name):
                         unified_event_sheet.add_cols(len(expected_headers) - current_cols)
                     # Actualizar encabezados
                     unified_event_sheet.update(f'A1:{gspread.utils.rowcol_to_a1(1, len(expected_headers))}', [expected_headers])
+                    sheet_conn.set_cached_headers(unified_event_sheet, expected_headers)
                     logger.info(f"Hoja '{unified_sheet_name}' actualizada con nuevos encabezados.")
+                sheet_conn.set_verified_sheet(unified_sheet_name, unified_event_sheet)
             except Exception as header_err:
                 logger.warning(f"Error al verificar/actualizar encabezados en hoja existente: {header_err}")
             
@@ -438,6 +912,8 @@ def get_or_create_unified_event_sheet(sheet_conn, event_name):
                 f'A1:{gspread.utils.rowcol_to_a1(1, len(expected_headers))}', 
                 [expected_headers]
             )
+            sheet_conn.set_cached_headers(unified_event_sheet, expected_headers)
+            sheet_conn.set_verified_sheet(unified_sheet_name, unified_event_sheet)
             logger.info(f"Hoja unificada '{unified_sheet_name}' creada con encabezados: {expected_headers}")
             return unified_event_sheet
             
@@ -468,7 +944,7 @@ def get_or_create_vip_event_sheet(sheet_conn, event_name):
             # Verificar si la hoja existente tiene las columnas correctas
             expected_headers = ['Nombre', 'Email', 'Instagram', 'Ingreso', 'PR', 'Enviado']
             try:
-                headers = vip_event_sheet.row_values(1)
+                headers = sheet_conn.get_headers(vip_event_sheet)
                 if len(headers) < len(expected_headers) or headers[:len(expected_headers)] != expected_headers:
                     logger.info(f"Actualizando hoja VIP existente '{vip_sheet_name}' para incluir columna Enviado...")
                     # Expandir la hoja si es necesario
@@ -477,6 +953,7 @@ def get_or_create_vip_event_sheet(sheet_conn, event_name):
                         vip_event_sheet.add_cols(len(expected_headers) - current_cols)
                     # Actualizar encabezados
                     vip_event_sheet.update(f'A1:{gspread.utils.rowcol_to_a1(1, len(expected_headers))}', [expected_headers])
+                    sheet_conn.set_cached_headers(vip_event_sheet, expected_headers)
                     logger.info(f"Hoja VIP '{vip_sheet_name}' actualizada con nuevos encabezados.")
             except Exception as header_err:
                 logger.warning(f"Error al verificar/actualizar encabezados en hoja VIP existente: {header_err}")
@@ -511,21 +988,23 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
     
     Args:
         sheet: Objeto de hoja de Google Sheets unificada.
-        guests_list (list): Lista de diccionarios con info de invitados.
+        guests_list (list): Lista de Guest con info de invitados.
         pr_name (str): Nombre del PR que los está añadiendo.
         guest_type (str): 'VIP' o 'Normal' para determinar el tipo.
         sheet_conn: Instancia de SheetsConnection para obtener email del PR.
         
     Returns:
-        int: Número de invitados añadidos. 0 si hay error o no se añadió nada.
-             -1 si hubo datos pero se filtraron todos por inválidos.
+        tuple: (anotados, ya_estaban). anotados es la cantidad de filas nuevas escritas (puede ser 0
+               si todos ya estaban en la hoja); ya_estaban, los invitados omitidos por tener el mismo
+               email para este PR y tipo. (0, 0) si hubo un error; anotados == -1 si hubo invitados
+               con datos inválidos.
     """
     if not sheet:
         logger.error("Intento de añadir invitados pero la hoja unificada no es válida.")
-        return 0
+        return 0, 0
     if not guests_list:
         logger.warning("Se llamó a add_guests_to_unified_sheet con lista vacía o inválida.")
-        return 0
+        return 0, 0
 
     rows_to_add = []
     added_count = 0
@@ -538,7 +1017,7 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
         # --- Verificar/Crear encabezados (Nombre | Email | Instagram | TIPO | PR | EMAIL PR | Timestamp | Enviado) ---
         expected_headers = ['Nombre', 'Email', 'Instagram', 'TIPO', 'PR', 'EMAIL PR', 'Timestamp', 'Enviado']
         try:
-            headers = sheet.row_values(1)
+            headers = sheet_conn.get_headers(sheet)
         except gspread.exceptions.APIError as api_err:
              if "exceeds grid limits" in str(api_err): 
                  headers = []
@@ -546,13 +1025,17 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
                  raise api_err
 
         # Actualizar encabezados si es necesario
+        sheet_is_empty = not headers
         if headers != expected_headers:
             logger.info(f"Actualizando/Creando encabezados en hoja unificada: {expected_headers}")
             # Expandir la hoja para tener suficientes columnas si es necesario
             current_cols = sheet.col_count
             if current_cols < len(expected_headers):
                 sheet.add_cols(len(expected_headers) - current_cols)
+            # Solo la fila 1: si dos PRs escriben a la vez en una hoja vacía, ambos escriben lo mismo.
+            # Las filas de datos van siempre por append (nunca a un rango fijo desde A2)
             sheet.update(f'A1:{gspread.utils.rowcol_to_a1(1, len(expected_headers))}', [expected_headers])
+            sheet_conn.set_cached_headers(sheet, expected_headers)
 
         # --- Obtener email del PR desde la hoja Telefonos ---
         pr_email = ""  # Fallback vacío
@@ -561,33 +1044,44 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
             # Por ahora, intentamos obtener el email basado en el mapeo reverso
             pr_email_mapping = sheet_conn.get_phone_pr_email_mapping()
             
-            # Buscar el email correspondiente al pr_name
-            for phone, email in pr_email_mapping.items():
-                # Obtener el mapeo de teléfono a nombre PR para hacer la correlación
-                pr_name_mapping = sheet_conn.get_phone_pr_mapping()
-                if phone in pr_name_mapping and pr_name_mapping[phone] == pr_name:
-                    pr_email = email
-                    logger.info(f"Email PR encontrado para '{pr_name}': {pr_email}")
-                    break
+            # Buscar el email correspondiente al pr_name (mapeo teléfono -> nombre PR leído una sola vez)
+            pr_name_mapping = sheet_conn.get_phone_pr_mapping()
+            pr_email = next((email for phone, email in pr_email_mapping.items()
+                             if phone in pr_name_mapping and pr_name_mapping[phone] == pr_name), "")
             
-            if not pr_email:
+            if pr_email:
+                logger.info(f"Email PR encontrado para '{pr_name}': {pr_email}")
+            else:
                 logger.warning(f"No se encontró email para PR '{pr_name}'. Usando vacío.")
                 
         except Exception as e:
             logger.error(f"Error al obtener email del PR '{pr_name}': {e}")
             pr_email = ""  # Fallback vacío
 
+        # --- Emails ya anotados por este PR con el mismo tipo (General/VIP), desde la caché de registros:
+        # evita duplicar filas si se reenvía el mensaje ---
+        tipo_prefix = "GENERAL" if guest_type.upper() == 'NORMAL' else "VIP"
+        existing_emails = set()
+        duplicate_count = 0
+        if not sheet_is_empty:
+            try:
+                existing_emails = {str(record.get('Email', '')).strip().lower()
+                                   for record in sheet_conn.get_records_by_pr(sheet, pr_name)
+                                   if str(record.get('TIPO', '')).startswith(tipo_prefix)}
+            except Exception as dedup_err:
+                logger.warning(f"No se pudieron leer los invitados existentes para evitar duplicados: {dedup_err}")
+
         # --- Crear las filas ---
         for guest_data in guests_list:
             logger.info(f"DEBUG Add Unified Loop: Iterando, tipo={type(guest_data)}, item={guest_data}")
             
-            # Combinar nombre y apellido si están separados
-            nombre = guest_data.get('nombre', '').strip()
-            apellido = guest_data.get('apellido', '').strip()
+            # Desempaquetar la tupla Guest y combinar nombre y apellido si están separados
+            nombre, apellido, email, parsed_gender, instagram = guest_data # parsed_gender será 'Masculino', 'Femenino' o None
+            nombre = nombre.strip()
+            apellido = apellido.strip()
             name = f"{nombre} {apellido}".strip() if apellido else nombre
-            email = guest_data.get('email', '').strip()
-            instagram = guest_data.get('instagram', '').strip() if guest_type == 'VIP' else ""  # Solo VIP tiene Instagram
-            parsed_gender = guest_data.get('genero') # Será 'Masculino', 'Femenino' o None
+            email = email.strip()
+            instagram = instagram.strip() if guest_type == 'VIP' else ""  # Solo VIP tiene Instagram
 
             # Validar datos requeridos según el tipo
             valid_data = False
@@ -596,14 +1090,18 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
             else:
                 valid_data = name and email  # Normal solo requiere nombre y email
 
-            if valid_data:
+            if valid_data and email.lower() in existing_emails:
+                # Ya está en la hoja (mismo email para este PR): no se vuelve a escribir
+                duplicate_count += 1
+            elif valid_data:
                 # --- Determinar/Inferir Género ---
                 final_gender = "Desconocido"
                 if parsed_gender:
                     # Convertir género a formato esperado para TIPO
-                    if parsed_gender.lower() in ['masculino', 'hombre']:
+                    parsed_gender_key = parsed_gender.casefold()
+                    if parsed_gender_key in MALE_LABELS:
                         gender_for_tipo = "HOMBRE"
-                    elif parsed_gender.lower() in ['femenino', 'mujer']:
+                    elif parsed_gender_key in FEMALE_LABELS:
                         gender_for_tipo = "MUJER"
                     else:
                         gender_for_tipo = "DESCONOCIDO"
@@ -613,9 +1111,10 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
                     if first_name:
                          # Llamar a la función de IA
                          inferred = infer_gender_llm(first_name)
-                         if inferred.lower() in ['hombre', 'masculino']:
+                         inferred_key = inferred.casefold()
+                         if inferred_key in MALE_LABELS:
                              gender_for_tipo = "HOMBRE"
-                         elif inferred.lower() in ['mujer', 'femenino']:
+                         elif inferred_key in FEMALE_LABELS:
                              gender_for_tipo = "MUJER"
                          else:
                              gender_for_tipo = "DESCONOCIDO"
@@ -632,28 +1131,45 @@ def add_guests_to_unified_sheet(sheet, guests_list, pr_name, guest_type, sheet_c
                 row_data = [name, email, instagram, tipo_value, pr_name, pr_email, timestamp, False]
                 rows_to_add.append(row_data)
                 added_count += 1
+                # Un email repetido dentro del mismo mensaje también cuenta como ya anotado
+                existing_emails.add(email.lower())
             else:
                 logger.warning(f"Se omitió invitado (nombre='{name}', email='{email}', instagram='{instagram}', tipo='{guest_type}') por datos faltantes. PR: {pr_name}.")
 
+        if duplicate_count:
+            logger.info(f"Se omitieron {duplicate_count} invitados ya anotados por PR '{pr_name}' (mismo email).")
+        # Los duplicados cuentan como procesados (ya están en la hoja), pero no como anotados
+        processed_count = added_count + duplicate_count
+
         # --- Agregar a la hoja ---
         if rows_to_add:
-            sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
-            # Limpiar colores de fondo de las filas recién agregadas
-            clear_background_color_for_new_rows(sheet, len(rows_to_add))
+            # La cola agrupa esta escritura con las de otras solicitudes concurrentes
+            # y limpia el color de fondo de las filas nuevas
+            sheets_write_queue.write_rows(sheet, rows_to_add)
+            sheet_conn.invalidate_records(sheet)
             logger.info(f"Agregados {added_count} invitados {guest_type} a hoja unificada por PR '{pr_name}'.")
-            return added_count if added_count == original_count else -1
+        if processed_count:
+            return (added_count if processed_count == original_count else -1), duplicate_count
         else:
             logger.warning(f"No se generaron filas válidas para añadir por {pr_name}.")
-            return -1 if original_count > 0 else 0
+            return (-1 if original_count > 0 else 0), 0
 
     except gspread.exceptions.APIError as e:
         logger.error(f"Error API Google Sheets al agregar filas a hoja unificada: {e}")
-        return 0
+        return 0, 0
     except Exception as e:
         logger.error(f"Error inesperado en add_guests_to_unified_sheet: {e}")
         import traceback
         logger.error(traceback.format_exc())
-        return 0
+        return 0, 0
+
+def unified_add_success_text(added_count, duplicate_count, type_label, event_name):
+    """ Respuesta de éxito de add_guests_to_unified_sheet: distingue anotados de los que ya estaban """
+    if not duplicate_count:
+        return f"✅ ¡Éxito! Se anotaron *{added_count}* invitado(s) {type_label} para el evento *{event_name}*."
+    icon = "✅" if added_count else "ℹ️"
+    return (f"{icon} Invitados {type_label} para el evento *{event_name}*: "
+            f"*{added_count}* anotado(s), *{duplicate_count}* ya estaban en la lista.")
 
 def add_vip_guests_to_sheet(sheet, vip_guests_list, pr_name):
     """
@@ -756,6 +1272,117 @@ def add_vip_guests_to_sheet(sheet, vip_guests_list, pr_name):
         return 0
 
 
+class _DigitsOnlyTable(dict):
+    """
+    Tabla para str.translate que conserva solo dígitos decimales (lo mismo que quitar \\D).
+    Cada carácter nuevo se clasifica una vez y queda memorizado en el dict.
+    """
+    def __missing__(self, codepoint):
+        value = codepoint if chr(codepoint).isdecimal() else None
+        self[codepoint] = value
+        return value
+
+_PHONE_TT = _DigitsOnlyTable()
+
+def normalize_phone(value):
+    """ Deja solo los dígitos del teléfono ('whatsapp:+54 9 11...' -> '54911...') en una pasada en C """
+    phone = str(value)
+    return phone if phone.isdecimal() else phone.translate(_PHONE_TT)
+
+def normalize_phone_set(values):
+    """ Set de teléfonos normalizados de una columna, sin celdas vacías ni valores sin dígitos """
+    return {phone for phone in map(normalize_phone, filter(None, values)) if phone}
+
+
+# Motor RE2 (google-re2) opcional para los patrones lineales de validación
+RE2_AVAILABLE = False
+try:
+    import re2
+    RE2_AVAILABLE = True
+except ImportError:
+    logger.info("Módulo re2 no está instalado. Se usará el motor de regex estándar.")
+
+# En RE2 \s, \w, \d y \b solo reconocen ASCII: un NBSP (frecuente en texto pegado en WhatsApp)
+# dejaría de contar como espacio y cambiaría el resultado. Esos patrones se compilan siempre con re.
+RE2_UNSAFE_CLASSES = (r'\s', r'\S', r'\w', r'\W', r'\d', r'\D', r'\b', r'\B')
+
+def _compile_linear(pattern):
+    """ Compila con RE2 si está disponible y acepta el patrón sin cambiar su semántica; si no, con re """
+    if RE2_AVAILABLE and not any(token in pattern for token in RE2_UNSAFE_CLASSES):
+        try:
+            return re2.compile(pattern)
+        except Exception as e:
+            logger.debug(f"RE2 no acepta el patrón {pattern!r} ({e}); se usa re")
+    return re.compile(pattern)
+
+# --- Expresiones regulares precompiladas (se compilan una vez al importar el módulo) ---
+# Cada lista de patrones se fusiona en una sola alternancia: el motor de regex recorre el texto una vez
+COUNT_PATTERN = r'cu[aá]ntos invitados|contar invitados|total de invitados|invitados totales|lista de invitados'
+QR_COMMAND_RE = re.compile(r'(?i)^(?:enviar|send|procesar|mandar)\s+qr|^qr\s+send')
+
+# Saludos y comandos de ayuda exactos (el mensaje completo, sin espacios alrededor)
+GREETINGS = frozenset({"hola", "buenos días", "buenas tardes", "buenas noches", "saludos",
+                       "hi", "hey", "hello", "ola", "buen día"})
+HELP_COMMANDS = frozenset({"ayuda", "help"})
+_GREETINGS_ALT = "|".join(map(re.escape, sorted(GREETINGS)))
+_HELP_COMMANDS_ALT = "|".join(map(re.escape, sorted(HELP_COMMANDS)))
+
+# Clasificadores de una sola pasada: cada rama es un grupo con nombre y se prueban en orden de
+# prioridad; m.lastgroup dice cuál coincidió. Las ramas "contiene" usan lookahead desde el inicio.
+# Comandos simples (classify_command), sobre el mensaje ya normalizado con strip + lower
+COMMAND_CLASSIFIER_RE = re.compile(
+    rf"(?s)(?P<saludo>(?:{_GREETINGS_ALT})\Z)"
+    rf"|(?=.*?(?P<count>{COUNT_PATTERN}))"
+    rf"|(?P<help>(?:{_HELP_COMMANDS_ALT})\Z|(?=.*?c[oó]mo (?:funciona|usar)))"
+)
+# Intenciones de analyze_with_rules, sobre el texto en minúsculas
+INTENT_CLASSIFIER_RE = re.compile(
+    r"(?s)(?=.*?(?P<add>agregar|añadir|sumar|incluir|(?:hombres|mujeres)\s*\n))"
+    r"|(?=.*?(?P<query>cuántos|cantidad|lista|invitados\s+tengo|ver\s+invitados))"
+    rf"|(?P<help>\s*(?:{_HELP_COMMANDS_ALT})\s*\Z|(?=.*?cómo\s+(?:funciona|usar)))"
+    rf"|(?P<greeting>\s*(?:{_GREETINGS_ALT})\s*\Z)"
+)
+INTENT_BY_GROUP = {"add": "adición_invitado", "query": "consulta_invitados", "help": "ayuda", "greeting": "saludo"}
+
+# Encabezados y validación de líneas: patrones lineales (sin lookahead ni backreferences). Los que no
+# usan \s, \w, \d ni \b (los de email) se compilan con RE2 si está instalado: sin backtracking,
+# tiempo lineal aun con entradas raras. El resto queda en re (ver RE2_UNSAFE_CLASSES).
+CATEGORY_HEADER_RE = _compile_linear(r'(?i)^(Hombres|Mujeres|Niños|Adultos|Familia)[\s:]*$')
+SPLIT_MALE_HEADER_RE = _compile_linear(r'(?i)^(hombres?|varones?)[\s:]*$')
+SPLIT_FEMALE_HEADER_RE = _compile_linear(r'(?i)^(mujeres?|damas?)[\s:]*$')
+VIP_MALE_HEADER_RE = _compile_linear(r'(?i)^hombres?\s*:?\s*$')
+VIP_FEMALE_HEADER_RE = _compile_linear(r'(?i)^mujeres?\s*:?\s*$')
+EMAIL_LINE_RE = _compile_linear(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$")
+EMAIL_FIND_RE = _compile_linear(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+# Hay un '.' entre el primer '@' y el siguiente '@' (o el final): equivale a '.' in line.split('@')[1]
+AT_DOT_RE = _compile_linear(r'[^@]*@[^@]*\.')
+# Clases acotadas (sin '@' ni espacios): no hay backtracking entre tramos, tiempo lineal
+LOOSE_EMAIL_RE = _compile_linear(r'[^\s@]+@[^\s@]+\.[^\s@]+')
+BASIC_EMAIL_RE = _compile_linear(r"[^@]+@[^@]+\.[^@]+")
+NAME_LINE_RE = _compile_linear(r"^[a-zA-ZáéíóúÁÉÍÓÚñÑüÜ\s']+$")
+VIP_NAME_LINE_RE = _compile_linear(r"^[a-zA-ZáéíóúÁÉÍÓÚñÑüÜ\s'.]+$")
+
+# Palabras clave de sentimiento/urgencia: se comparan por palabra completa con intersección de sets
+WORD_RE = re.compile(r"\w+")
+POSITIVE_WORDS = frozenset(("gracias", "excelente", "genial", "bueno", "perfecto", "bien"))
+NEGATIVE_WORDS = frozenset(("error", "problema", "mal", "falla", "arregla"))
+URGENCY_WORDS = frozenset(("urgente", "inmediato", "rápido", "ya"))
+
+# Literales de pertenencia usados por invitado/mensaje: frozensets de módulo en lugar de listas por llamada
+MALE_LABELS = frozenset(("masculino", "hombre"))  # comparar con casefold()
+FEMALE_LABELS = frozenset(("femenino", "mujer"))
+MALE_CATEGORY_LABELS = MALE_LABELS | {"hombres"}  # encabezados de categoría (singular o plural)
+FEMALE_CATEGORY_LABELS = FEMALE_LABELS | {"mujeres"}
+GUEST_LINE_SEPARATORS = (" - ", "-", ":")  # separadores nombre/email por prioridad
+CANCEL_COMMANDS = frozenset(("cancelar", "salir", "cancel", "exit"))
+FORMAT_ERROR_TYPES = frozenset(("no_valid_categories", "empty_message", "incomplete_category", "no_valid_pairs"))
+TRUTHY_CELL_VALUES = frozenset(("TRUE", "SI", "SÍ", "YES", "1"))
+# Nombre a mostrar por género en los conteos (claves con casefold())
+GENDER_DISPLAY_NAMES = {"masculino": "Hombres", "femenino": "Mujeres"}
+
+# Textos más largos que esto (listas de invitados) no se guardan en la caché de analyze_with_rules
+RULES_CACHE_MAX_LEN = 256  # caracteres
+
 def analyze_with_rules(text):
     """
     Analiza el texto utilizando reglas simples cuando OpenAI no está disponible
@@ -766,74 +1393,32 @@ def analyze_with_rules(text):
     Returns:
         dict: Análisis básico del mensaje
     """
-    # Patrones para detectar intenciones mediante expresiones regulares
-    patterns = {
-        "adición_invitado": [
-            r"(?i)agregar",
-            r"(?i)añadir",
-            r"(?i)sumar",
-            r"(?i)incluir",
-            r"(?i)hombres\s*\n",
-            r"(?i)mujeres\s*\n"
-        ],
-        "consulta_invitados": [
-            r"(?i)cuántos",
-            r"(?i)cantidad",
-            r"(?i)lista",
-            r"(?i)lista\s+de\s+invitados",
-            r"(?i)invitados\s+tengo",
-            r"(?i)ver\s+invitados"
-        ],
-        "ayuda": [
-            r"(?i)^ayuda$",
-            r"(?i)^help$",
-            r"(?i)cómo\s+funciona",
-            r"(?i)cómo\s+usar"
-        ],
-        "saludo": [
-            r"(?i)^hola$",
-            r"(?i)^buenos días$",
-            r"(?i)^buenas tardes$",
-            r"(?i)^buenas noches$",
-            r"(?i)^saludos$",
-            r"(?i)^hi$",
-            r"(?i)^hey$",
-            r"(?i)^hello$",
-            r"(?i)^ola$",
-            r"(?i)^buen día$"
-        ]
-    }
+    # Todas las reglas ignoran mayúsculas, así que el texto en minúsculas sirve de clave de caché.
+    # Los textos largos (listas de invitados) casi nunca se repiten y no ocupan lugar en la caché.
+    # Se devuelve una copia para que el llamador no modifique el resultado compartido.
+    text_low = text.lower()
+    if len(text_low) > RULES_CACHE_MAX_LEN:
+        return _analyze_with_rules(text_low)
+    return dict(_analyze_with_rules_cached(text_low))
+
+def _analyze_with_rules(text):
+    """ Cuerpo de analyze_with_rules sobre el texto en minúsculas """
+    # Detectar la intención con el clasificador de una sola pasada
+    match = INTENT_CLASSIFIER_RE.match(text)
+    intent = INTENT_BY_GROUP[match.lastgroup] if match else "otro"
     
-    # Detectar la intención según los patrones
-    intent = "otro"
-    for intent_name, patterns_list in patterns.items():
-        for pattern in patterns_list:
-            if re.search(pattern, text):
-                intent = intent_name
-                break
-        if intent != "otro":
-            break
-    
-    # Análisis de sentimiento básico basado en palabras clave
-    positive_words = ["gracias", "excelente", "genial", "bueno", "perfecto", "bien"]
-    negative_words = ["error", "problema", "mal", "falla", "no funciona", "arregla"]
+    # Análisis de sentimiento básico basado en palabras clave (tokenizar una vez y cruzar con los sets)
+    tokens = set(WORD_RE.findall(text))
     
-    text_lower = text.lower()
     sentiment = "neutral"
-    
-    for word in positive_words:
-        if word in text_lower:
-            sentiment = "positivo"
-            break
-            
-    for word in negative_words:
-        if word in text_lower:
-            sentiment = "negativo"
-            break
+    if tokens & NEGATIVE_WORDS or "no funciona" in text:
+        sentiment = "negativo"
+    elif tokens & POSITIVE_WORDS:
+        sentiment = "positivo"
     
     # Determinar urgencia basado en signos de exclamación y palabras clave de urgencia
     urgency = "media"
-    if text.count("!") > 1 or any(w in text_lower for w in ["urgente", "inmediato", "rápido", "ya"]):
+    if text.count("!") > 1 or tokens & URGENCY_WORDS:
         urgency = "alta"
     
     return {
@@ -842,17 +1427,64 @@ def analyze_with_rules(text):
         "urgency": urgency
     }
 
+_analyze_with_rules_cached = lru_cache(maxsize=4096)(_analyze_with_rules)
+
 
 # Configuración de OpenAI (con manejo de importación segura)
 OPENAI_AVAILABLE = False
+# Límite de llamadas a OpenAI por proceso para absorber ráfagas sin errores 429
+_openai_bucket = TokenBucket(rate=50, capacity=100)
+RULES_ONLY_MAX_LEN = 8  # caracteres
+SENTIMENT_MAX_CHARS = 200  # para el tono alcanza el comienzo del mensaje
+OPENAI_HTTP_TIMEOUT = 30.0  # segundos; la extracción de listas largas puede demorar
+# Extracción de invitados: esquema fijo para que la respuesta se pueda leer con json.loads directamente
+GUEST_EXTRACTION_SEED = 42
+GUEST_EXTRACTION_SYSTEM_PROMPT = (
+    "Eres un asistente especializado en extraer información estructurada de textos. "
+    "Responde únicamente con un objeto JSON con este formato: "
+    '{"guests": [{"nombre": "...", "apellido": "...", "email": "...", "genero": "..."}]}'
+)
+GUEST_EXTRACTION_PROMPT = """
+        A continuación hay una lista de invitados. {category_context}Por favor, extrae y estructura la información de cada invitado en formato JSON.
+        
+        Reglas importantes:
+        1. Cada línea o entrada debe corresponder exactamente a un invitado.
+        2. Cada invitado debe tener un nombre y un email asociado.
+        3. Si ves un guión o un separador entre el nombre y el email, úsalo para separarlos.
+        4. Si una línea incluye "Hombres:" o "Mujeres:", es un encabezado de categoría, no un invitado.
+        5. El género debe ser "Masculino" si está en la categoría "Hombres" y "Femenino" si está en "Mujeres".
+        
+        Para cada invitado, identifica estos campos:
+        - nombre: solo el primer nombre de la persona
+        - apellido: solo el apellido de la persona
+        - email: el email de la persona (debe haber exactamente un email por invitado)
+        - genero: "Masculino", "Femenino" u "Otro" basado en el contexto y nombre
+        
+        Lista de invitados:
+        {guests_text}
+        
+        Responde solo con el objeto JSON {{"guests": [...]}}. Cada elemento de "guests" debe corresponder a un invitado único con su email.
+        """
 try:
     from openai import OpenAI  # Cambiar la importación para la nueva versión
+    try:
+        import httpx  # Cliente HTTP del SDK de OpenAI 1.x
+    except ImportError:
+        httpx = None
     
     # Verificar si la clave API está disponible
     api_key = os.environ.get("OPENAI_API_KEY")
     if api_key:
-        # Inicializar el cliente de forma correcta
-        client = OpenAI(api_key=api_key)
+        if httpx is not None:
+            # Pool HTTP explícito: las conexiones keep-alive a api.openai.com se reutilizan entre
+            # llamadas (sentimiento, invitados, género) en lugar de abrir TLS de nuevo bajo carga
+            _openai_http = httpx.Client(
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+                timeout=httpx.Timeout(OPENAI_HTTP_TIMEOUT, connect=5.0)
+            )
+            client = OpenAI(api_key=api_key, http_client=_openai_http)
+        else:
+            client = OpenAI(api_key=api_key)
         OPENAI_AVAILABLE = True
         logger.info("OpenAI está disponible")
     else:
@@ -861,20 +1493,86 @@ except ImportError:
     logger.warning("Módulo OpenAI no está instalado. Se usará análisis básico.")
     client = None
 
+# Celda de 'Telefonos' con un número de revisión que se cambia al editar los teléfonos autorizados.
+# Opcional: sin configurar (por defecto) se relee la columna completa cada vez que vence la caché.
+PHONES_REVISION_CELL = os.environ.get('PHONES_REVISION_CELL', '')
+# Aunque la revisión no cambie, la columna se relee si la última lectura completa tiene más de esto:
+# un teléfono quitado sin cambiar la celda deja de estar autorizado a lo sumo en este plazo.
+PHONES_REVISION_MAX_AGE = int(os.environ.get('PHONES_REVISION_MAX_AGE', '1800'))  # segundos
+
 # --- Conexión a Google Sheets ---
 class SheetsConnection:
     _instance = None
     _last_refresh = 0
     _refresh_interval = 1800  # 30 minutos
+    _refresh_in_progress = False
     _phone_cache_interval = 300
+    _records_cache_interval = 60  # Registros de invitados: TTL corto, se invalida al agregar filas
+    _lock = threading.Lock()
 
     def __new__(cls):
-        if cls._instance is None or time.time() - cls._last_refresh > cls._refresh_interval:
-            cls._instance = super(SheetsConnection, cls).__new__(cls)
-            cls._instance._connect()
-            cls._last_refresh = time.time()
+        # Camino rápido sin lock: la instancia se conserva siempre; si la renovación periódica
+        # venció, se hace en un hilo aparte y el request sigue con el cliente actual
+        instance = cls._instance
+        if instance is not None:
+            if time.time() - cls._last_refresh > cls._refresh_interval:
+                cls._schedule_refresh()
+            return instance
+
+        with cls._lock:
+            # Volver a verificar dentro del lock: otro hilo pudo haber conectado mientras esperábamos
+            if cls._instance is None:
+                instance = super(SheetsConnection, cls).__new__(cls)
+                instance._connect()
+                cls._instance = instance # Publicar solo si la conexión terminó bien
+                cls._last_refresh = time.time()
         return cls._instance
 
+    @classmethod
+    def _schedule_refresh(cls):
+        """ Lanza (una sola vez a la vez) la renovación de credenciales en segundo plano """
+        with cls._lock:
+            if cls._refresh_in_progress:
+                return
+            cls._refresh_in_progress = True
+
+        def _async_refresh():
+            try:
+                cls._instance._refresh_credentials()
+            finally:
+                cls._last_refresh = time.time()
+                cls._refresh_in_progress = False
+
+        threading.Thread(target=_async_refresh, name="sheets-refresh", daemon=True).start()
+
+    def _refresh_credentials(self, force=False):
+        """
+        Renueva solo el token OAuth del cliente gspread existente, sin releer el keyfile
+        ni reabrir las hojas. Las cachés de la instancia se conservan.
+        """
+        try:
+            http_client = self.client.http_client
+            if force or not http_client.auth.valid:
+                http_client.login()
+                logger.info("Token de Google Sheets renovado.")
+        except Exception as e:
+            logger.warning(f"No se pudo renovar el token de Google Sheets ({e}). Reconectando...")
+            self._connect()
+
+    def _with_refresh(self, fn, *args, **kwargs):
+        """
+        Ejecuta una llamada a la API de Sheets; si falla por credenciales (401/403), renueva el token
+        y reintenta una vez. Invalidación perezosa: solo se reautentica cuando la API lo pide.
+        """
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if getattr(e, 'code', None) not in (401, 403):
+                raise
+            logger.warning(f"Error de credenciales en Google Sheets ({e.code}). Renovando token y reintentando...")
+            self._refresh_credentials(force=True)
+            return fn(*args, **kwargs)
+
     def _connect(self):
         try:
             scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
@@ -899,6 +1597,8 @@ class SheetsConnection:
                     creds = ServiceAccountCredentials.from_json_keyfile_name(creds_path_fallback, scope)
             
             self.client = gspread.authorize(creds)
+            # Sin timeout una llamada colgada bloquearía para siempre el hilo de la cola de escrituras
+            self.client.set_timeout(SHEETS_HTTP_TIMEOUT)
             self.spreadsheet = self.client.open("n8n sheet") # Nombre del Archivo Google Sheet
 
             # --- Obtener hojas principales (manejar si no existen) ---
@@ -991,6 +1691,11 @@ class SheetsConnection:
             # ---> ¡AQUÍ! Inicializar atributos de caché en la instancia SIEMPRE <---
             self._phone_cache = None
             self._phone_cache_last_refresh = 0
+            self._phone_cache_revision = None  # Valor de PHONES_REVISION_CELL al cargar _phone_cache
+            self._phone_cache_loaded_at = 0  # Última lectura completa de la columna de teléfonos
+            self._verified_sheets = {}  # {título: (worksheet, timestamp)} hojas de evento con encabezados ya verificados
+            self._events_cache = None  # Lista de eventos de la hoja 'Eventos'
+            self._events_cache_last_refresh = 0
             self._pr_name_map_cache = None # NUEVO: Cache para el mapeo tel -> nombre PR
             self._vip_phone_cache = None # NUEVO: Cache para teléfonos VIP
             self._vip_phone_cache_last_refresh = 0 # NUEVO: Timestamp para caché VIP
@@ -1000,6 +1705,8 @@ class SheetsConnection:
             self._qr_special_cache_last_refresh = 0 # NUEVO: Timestamp para caché QR especiales
             self._event_state_cache = None # NUEVO: Cache para estado de eventos QR
             self._event_state_cache_last_refresh = 0 # NUEVO: Timestamp para caché estado eventos
+            self._headers_cache = {} # NUEVO: Cache de encabezados (fila 1) por ID de hoja -> (headers, timestamp)
+            self._records_cache = {} # NUEVO: Cache de registros por ID de hoja -> (headers, filas crudas, timestamp, índice por PR)
 
             # _phone_cache_interval es constante de clase, está bien así.
 
@@ -1018,6 +1725,92 @@ class SheetsConnection:
             logger.error(f"Error CRÍTICO inesperado al conectar con Google Sheets: {e}")
             raise
 
+    def get_headers(self, sheet, max_age=None):
+        """
+        Devuelve los encabezados (fila 1) de la hoja, usando caché por ID de hoja.
+        Evita una llamada a la API en cada alta de invitados.
+        """
+        if max_age is None:
+            max_age = self._phone_cache_interval
+        now = time.time()
+        cached = self._headers_cache.get(sheet.id)
+        if cached is not None and now - cached[1] < max_age:
+            return list(cached[0])
+
+        headers = self._with_refresh(sheet.row_values, 1)
+        self._headers_cache[sheet.id] = (headers, now)
+        return list(headers)
+
+    def set_cached_headers(self, sheet, headers):
+        """ Actualiza la caché de encabezados después de escribirlos en la hoja """
+        self._headers_cache[sheet.id] = (list(headers), time.time())
+
+    def get_verified_sheet(self, title):
+        """ Devuelve la hoja de evento ya abierta y con encabezados verificados, o None si no está o venció """
+        cached = self._verified_sheets.get(title)
+        if cached is not None and time.time() - cached[1] < self._phone_cache_interval:
+            return cached[0]
+        return None
+
+    def set_verified_sheet(self, title, sheet):
+        """ Recuerda una hoja de evento cuyos encabezados ya se verificaron (o se acaban de escribir) """
+        self._verified_sheets[title] = (sheet, time.time())
+
+    def count_records(self, sheet):
+        """ Cantidad de filas de datos (sin encabezados) de la hoja, desde la caché """
+        return len(self._get_records_entry(sheet)[1])
+
+    def get_records_by_pr(self, sheet, *pr_values):
+        """
+        Devuelve los registros cuya columna 'PR' coincide con alguno de los valores dados,
+        en el orden de la hoja. Usa un índice PR -> posiciones armado una sola vez por carga
+        de la caché, en lugar de recorrer toda la hoja en cada consulta. Solo se arman
+        dicts para las filas que coinciden. Los valores se pasan por numericise igual que las claves
+        del índice: un PR guardado como teléfono (fallback) se indexa como int.
+        """
+        headers, rows, _, pr_index = self._get_records_entry(sheet)
+        lookup_values = dict.fromkeys(gspread.utils.numericise(value) for value in pr_values)
+        position_lists = [pr_index[value] for value in lookup_values if value in pr_index]
+        if not position_lists:
+            return []
+        positions = position_lists[0] if len(position_lists) == 1 else heapq.merge(*position_lists)
+        return [self._to_record(headers, rows[i]) for i in positions]
+
+    @staticmethod
+    def _to_record(headers, row):
+        """ Fila cruda -> dict, con la misma conversión numérica que get_all_records """
+        return dict(zip(headers, gspread.utils.numericise_all(row)))
+
+    def _get_records_entry(self, sheet):
+        """
+        Devuelve (encabezados, filas crudas, timestamp, índice por PR) de la caché, recargando si expiró.
+        Se guardan los valores tal como llegan de la API (listas); los dicts se arman a demanda.
+        """
+        now = time.time()
+        cached = self._records_cache.get(sheet.id)
+        if cached is not None and now - cached[2] < self._records_cache_interval:
+            return cached
+
+        values = self._with_refresh(sheet.get, pad_values=True)
+        headers = values[0] if values else []
+        rows = values[1:]
+        if len(headers) != len(set(headers)):
+            # Mismo criterio que get_all_records
+            raise gspread.exceptions.GSpreadException(f"La fila de encabezados de '{sheet.title}' tiene columnas repetidas")
+
+        pr_index = {}
+        if 'PR' in headers:
+            pr_col = headers.index('PR')
+            for i, row in enumerate(rows):
+                pr_index.setdefault(gspread.utils.numericise(row[pr_col]), []).append(i)
+        entry = (headers, rows, now, pr_index)
+        self._records_cache[sheet.id] = entry
+        return entry
+
+    def invalidate_records(self, sheet):
+        """ Descarta los registros en caché de la hoja (llamar después de agregar filas) """
+        self._records_cache.pop(sheet.id, None)
+
     def get_sheet_by_event_name(self, event_name):
         """
         Obtiene o crea una hoja específica para un evento determinado.
@@ -1033,13 +1826,10 @@ class SheetsConnection:
             event_sheet = self.spreadsheet.worksheet(event_name)
             logger.info(f"Hoja para evento '{event_name}' encontrada. ID: {event_sheet.id}")
             
-            # Verificar que realmente podemos acceder (prueba de lectura)
+            # Verificar que realmente podemos acceder: la lectura de encabezados (cacheada) sirve de prueba
             try:
-                cell_value = event_sheet.acell('A1').value
-                logger.info(f"Prueba de lectura exitosa: A1 = '{cell_value}'")
-                
                 # Verificar si la hoja tiene la columna ENVIADO, y si no, agregarla
-                headers = event_sheet.row_values(1)
+                headers = self.get_headers(event_sheet)
                 if len(headers) < 8 or 'ENVIADO' not in headers:
                     logger.info(f"Actualizando encabezados para incluir columna ENVIADO en '{event_name}'...")
                     # Expandir la hoja para tener suficientes columnas si es necesario
@@ -1051,6 +1841,7 @@ class SheetsConnection:
                     # Asegurar que solo tenemos exactamente 8 columnas
                     headers = headers[:8]  # Truncar a máximo 8 elementos
                     event_sheet.update('A1:H1', [headers])
+                    self.set_cached_headers(event_sheet, headers)
                     logger.info(f"Encabezados actualizados en hoja existente '{event_name}'")
                     
                     # Aplicar casillas de verificación a la columna ENVIADO
@@ -1124,7 +1915,7 @@ class SheetsConnection:
                             raw_phone = row[0] # Columna A (índice 0) - Telefonos VIP
                             pr_name = row[1]   # Columna B (índice 1) - Nombre PR VIP
                             if raw_phone and pr_name:
-                                normalized_phone = re.sub(r'\D', '', str(raw_phone))
+                                normalized_phone = normalize_phone(raw_phone)
                                 if normalized_phone:
                                     vip_phone_to_pr_map[normalized_phone] = pr_name.strip()
                         else:
@@ -1170,11 +1961,7 @@ class SheetsConnection:
             if vip_sheet:
                 # Asume Col A = Telefonos en hoja VIP, salta encabezado
                 vip_phone_list_raw = vip_sheet.col_values(1)[1:]
-                for phone in vip_phone_list_raw:
-                    if phone:
-                        normalized_phone = re.sub(r'\D', '', str(phone))
-                        if normalized_phone:
-                            vip_phones_set.add(normalized_phone)
+                vip_phones_set = normalize_phone_set(vip_phone_list_raw)
                 logger.info(f"Cargados {len(vip_phones_set)} números VIP.")
             else:
                 # Hoja VIP no encontrada o no accesible
@@ -1214,11 +2001,7 @@ class SheetsConnection:
             if qr_special_sheet:
                 # Asume Col A = Telefonos en hoja QR_Especiales, salta encabezado
                 qr_special_phone_list_raw = qr_special_sheet.col_values(1)[1:]
-                for phone in qr_special_phone_list_raw:
-                    if phone:
-                        normalized_phone = re.sub(r'\D', '', str(phone))
-                        if normalized_phone:
-                            qr_special_phones_set.add(normalized_phone)
+                qr_special_phones_set = normalize_phone_set(qr_special_phone_list_raw)
                 logger.info(f"Cargados {len(qr_special_phones_set)} números especiales QR.")
             else:
                 # Hoja QR_Especiales no encontrada o no accesible
@@ -1264,7 +2047,7 @@ class SheetsConnection:
                     if evento:
                         # Convertir a booleano si viene como string
                         if isinstance(qr_enviado, str):
-                            qr_enviado = qr_enviado.upper() in ['TRUE', 'SI', 'SÍ', 'YES', '1']
+                            qr_enviado = qr_enviado.upper() in TRUTHY_CELL_VALUES
                         elif qr_enviado is None:
                             qr_enviado = False
                         
@@ -1372,15 +2155,24 @@ class SheetsConnection:
 
     # --- NUEVO: Función para obtener eventos disponibles ---
     def get_available_events(self):
-        """ Obtiene la lista de eventos desde la hoja 'Eventos', ignorando el encabezado A1. """
+        """
+        Obtiene la lista de eventos desde la hoja 'Eventos', ignorando el encabezado A1.
+        Usa caché (la llena también prefetch_metadata junto con los teléfonos autorizados).
+        """
+        now = time.time()
+        if self._events_cache is not None and now - self._events_cache_last_refresh < self._phone_cache_interval:
+            return list(self._events_cache)
         try:
             event_sheet = self.get_event_sheet() # Usa el método que devuelve self.event_sheet
             if event_sheet:
                 # Obtener todos los valores de la primera columna
-                all_event_values = event_sheet.col_values(1)
+                all_event_values = self._with_refresh(event_sheet.col_values, 1)
                 # **CORRECCIÓN:** Ignorar el primer elemento (A1) y filtrar vacíos
                 events = [event for event in all_event_values[1:] if event]
                 logger.info(f"Eventos disponibles encontrados (sin encabezado): {events}")
+                self._events_cache = events
+                self._events_cache_last_refresh = now
+                events = list(events)
                 # CORREGIDO: Devolver la lista completa 'events'
                 return events # <---- CORREGIDO
             else:
@@ -1394,25 +2186,82 @@ class SheetsConnection:
             logger.error(f"Error inesperado al obtener eventos: {e}")
             return []
     
+    def prefetch_metadata(self):
+        """
+        Lee en una sola llamada values.batchGet la columna de teléfonos autorizados, la de eventos
+        y la celda de revisión de 'Telefonos', y llena las cachés de get_authorized_phones y
+        get_available_events (en lugar de dos col_values y un acell por separado).
+        """
+        phone_sheet = self.phone_sheet_obj
+        if not phone_sheet:
+            # Sin hoja 'Telefonos': cada método maneja su caso por separado
+            self.get_authorized_phones()
+            self.get_available_events()
+            return
+
+        ranges = [gspread.utils.absolute_range_name(phone_sheet.title, "A:A"),
+                  gspread.utils.absolute_range_name("Eventos", "A:A")]
+        if PHONES_REVISION_CELL:
+            ranges.append(gspread.utils.absolute_range_name(phone_sheet.title, PHONES_REVISION_CELL))
+        try:
+            value_ranges = self._with_refresh(self.spreadsheet.values_batch_get, ranges).get('valueRanges', [])
+        except gspread.exceptions.APIError as e:
+            # P. ej. falta la hoja 'Eventos' (rango inválido): leer cada una por separado
+            logger.warning(f"No se pudo precargar teléfonos y eventos en una sola llamada ({e}). Leyendo por separado...")
+            self.get_authorized_phones()
+            self.get_available_events()
+            return
+        # Misma forma que col_values: una celda por fila, '' en las filas vacías
+        columns = [[row[0] if row else '' for row in value_range.get('values', [])] for value_range in value_ranges]
+        columns += [[]] * (len(ranges) - len(columns))
+
+        now = time.time()
+        self._phone_cache = normalize_phone_set(columns[0][1:])
+        self._phone_cache_revision = (columns[2][0] or None) if len(columns) > 2 and columns[2] else None
+        self._phone_cache_last_refresh = now
+        self._phone_cache_loaded_at = now
+        self._events_cache = [event for event in columns[1][1:] if event]
+        self._events_cache_last_refresh = now
+        logger.info(f"Precargados {len(self._phone_cache)} números autorizados y {len(self._events_cache)} eventos.")
+
     # --- NUEVO: Método para obtener y cachear números autorizados ---
+    @staticmethod
+    def _read_phones_revision(phone_sheet):
+        """
+        Lee la celda de revisión de 'Telefonos' (PHONES_REVISION_CELL). Los administradores la cambian
+        al editar los números; vacía o ilegible devuelve None y se relee la columna completa.
+        """
+        if not phone_sheet or not PHONES_REVISION_CELL:
+            return None
+        try:
+            return phone_sheet.acell(PHONES_REVISION_CELL).value or None
+        except Exception as e:
+            logger.debug(f"No se pudo leer la celda de revisión {PHONES_REVISION_CELL} de 'Telefonos': {e}")
+            return None
+
     def get_authorized_phones(self):
         now = time.time()
         # Ahora self._phone_cache sí existirá (inicialmente None)
         if self._phone_cache is not None and now - self._phone_cache_last_refresh < self._phone_cache_interval:
              return self._phone_cache
 
-        logger.info("Refrescando caché de números autorizados...")
         authorized_phones_set = set()
         try:
             # Usar el objeto ya obtenido (o None) en _connect
             phone_sheet = self.phone_sheet_obj
+
+            # Celda de revisión: si no cambió desde la última carga (y esa carga no es muy vieja),
+            # alcanza con leer una celda
+            revision = self._read_phones_revision(phone_sheet)
+            if (revision and self._phone_cache is not None and revision == self._phone_cache_revision
+                    and now - self._phone_cache_loaded_at < PHONES_REVISION_MAX_AGE):
+                self._phone_cache_last_refresh = now
+                return self._phone_cache
+
+            logger.info("Refrescando caché de números autorizados...")
             if phone_sheet:
-                phone_list_raw = phone_sheet.col_values(1)[1:] # Asume Col A, skip header
-                for phone in phone_list_raw:
-                    if phone:
-                        normalized_phone = re.sub(r'\D', '', str(phone))
-                        if normalized_phone:
-                            authorized_phones_set.add(normalized_phone)
+                phone_list_raw = self._with_refresh(phone_sheet.col_values, 1)[1:] # Asume Col A, skip header
+                authorized_phones_set = normalize_phone_set(phone_list_raw)
                 logger.info(f"Cargados {len(authorized_phones_set)} números autorizados.")
             else:
                  logger.error("No se puede refrescar caché porque hoja 'Telefonos' no está disponible.")
@@ -1422,6 +2271,8 @@ class SheetsConnection:
 
             self._phone_cache = authorized_phones_set
             self._phone_cache_last_refresh = now
+            self._phone_cache_loaded_at = now
+            self._phone_cache_revision = revision
             return self._phone_cache
 
         # Manejar errores específicos al leer la hoja de teléfonos
@@ -1461,7 +2312,7 @@ class SheetsConnection:
                             raw_phone = row[0] # Columna A (índice 0)
                             pr_name = row[1]   # Columna B (índice 1)
                             if raw_phone and pr_name: # Solo procesar si ambos tienen valor
-                                normalized_phone = re.sub(r'\D', '', str(raw_phone))
+                                normalized_phone = normalize_phone(raw_phone)
                                 if normalized_phone:
                                     phone_to_pr_map[normalized_phone] = pr_name.strip()
                         else:
@@ -1510,7 +2361,7 @@ class SheetsConnection:
                             pr_name = row[1]   # Columna B (índice 1) - PR
                             pr_email = row[2]  # Columna C (índice 2) - Email
                             if raw_phone and pr_email: # Solo procesar si teléfono y email tienen valor
-                                normalized_phone = re.sub(r'\D', '', str(raw_phone))
+                                normalized_phone = normalize_phone(raw_phone)
                                 if normalized_phone:
                                     phone_to_pr_email_map[normalized_phone] = pr_email.strip()
                         else:
@@ -1549,28 +2400,68 @@ def analyze_sentiment(text):
             logger.warning("OpenAI no está disponible, usando análisis básico")
             return analyze_with_rules(text)
             
-        # Usar la API de OpenAI para analizar el sentimiento
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un asistente que analiza mensajes. Responde solo con un JSON que contiene: sentiment (positivo, negativo o neutral), intent (pregunta, solicitud, queja, adición_invitado, consulta_invitados, otro), y urgency (baja, media, alta)."},
-                {"role": "user", "content": text}
-            ],
-            response_format={"type": "json_object"}
-        )
-        
-        # Obtener la respuesta como JSON
-        analysis_text = response.choices[0].message.content
-        analysis = json.loads(analysis_text)
-        
-        logger.info(f"Análisis de sentimiento OpenAI: {analysis}")
-        return analysis
+        rules_analysis = analyze_with_rules(text)
+        # Si las reglas reconocen la intención (saludo, ayuda, agregar o consultar invitados) o el
+        # mensaje es muy corto, se responde con reglas sin llamar a OpenAI
+        if rules_analysis["intent"] != "otro" or len(text.strip()) <= RULES_ONLY_MAX_LEN:
+            return rules_analysis
+        # Clave normalizada: variantes de mayúsculas/espacios y colas largas comparten entrada en la caché.
+        # A OpenAI se le envía el texto original (las mayúsculas también transmiten el tono)
+        excerpt = text.strip()[:SENTIMENT_MAX_CHARS]
+        cache_key = excerpt.lower()
+        cached = _sentiment_cache_get(cache_key)
+        if cached is not None:
+            return cached
+        analysis = _analyze_sentiment_openai(excerpt)
+        _sentiment_cache_put(cache_key, analysis)
+        return dict(analysis)
         
     except Exception as e:
         logger.error(f"Error al analizar sentimiento con OpenAI: {e}")
         # En caso de error, usar análisis basado en reglas
         return analyze_with_rules(text)
 
+# Caché LRU de analyze_sentiment por texto normalizado. Solo se guardan respuestas exitosas
+_SENTIMENT_CACHE = OrderedDict()
+_SENTIMENT_CACHE_MAX = 4096
+_sentiment_cache_lock = threading.Lock()
+
+def _sentiment_cache_get(key):
+    with _sentiment_cache_lock:
+        if key not in _SENTIMENT_CACHE:
+            return None
+        _SENTIMENT_CACHE.move_to_end(key)
+        return dict(_SENTIMENT_CACHE[key])
+
+def _sentiment_cache_put(key, analysis):
+    with _sentiment_cache_lock:
+        _SENTIMENT_CACHE[key] = dict(analysis)
+        _SENTIMENT_CACHE.move_to_end(key)
+        if len(_SENTIMENT_CACHE) > _SENTIMENT_CACHE_MAX:
+            _SENTIMENT_CACHE.popitem(last=False)
+
+def _analyze_sentiment_openai(text):
+    """
+    Llamada a OpenAI de analyze_sentiment (sin caché).
+    """
+    # Usar la API de OpenAI para analizar el sentimiento
+    _openai_bucket.acquire()
+    response = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": "Eres un asistente que analiza mensajes. Responde solo con un JSON que contiene: sentiment (positivo, negativo o neutral), intent (pregunta, solicitud, queja, adición_invitado, consulta_invitados, otro), y urgency (baja, media, alta)."},
+            {"role": "user", "content": text}
+        ],
+        response_format={"type": "json_object"}
+    )
+    
+    # Obtener la respuesta como JSON
+    analysis_text = response.choices[0].message.content
+    analysis = json.loads(analysis_text)
+    
+    logger.info(f"Análisis de sentimiento OpenAI: {analysis}")
+    return analysis
+
 # Definir fuera de cualquier clase (como función global)
 def add_checkboxes_to_column(sheet, column_index, start_row=2, end_row=None):
     """
@@ -1624,6 +2515,48 @@ def add_checkboxes_to_column(sheet, column_index, start_row=2, end_row=None):
         return False
 
 # Actualizar la función analyze_guests_with_ai también
+_json_decoder = json.JSONDecoder()
+
+def _extract_json_array(text):
+    """
+    Decodifica el primer array JSON que aparece en el texto con el parser incremental
+    (sin regex con backtracking). Si un '[' no abre un array válido (p. ej. "[nota]" en el
+    texto del modelo), se prueba desde el siguiente. Devuelve None si no hay.
+    """
+    start = text.find('[')
+    while start >= 0:
+        try:
+            # Empezando en '[' el resultado, si decodifica, es siempre una lista
+            return _json_decoder.raw_decode(text, start)[0]
+        except json.JSONDecodeError:
+            start = text.find('[', start + 1)
+    return None
+
+# Caché LRU de resultados de analyze_guests_with_ai, por hash del contenido de la entrada
+_GUEST_CACHE = OrderedDict()
+_GUEST_CACHE_MAX = 512
+_guest_cache_lock = threading.Lock()
+
+def _guest_cache_key(guests_text, category_info):
+    payload = guests_text + json.dumps(category_info, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+def _guest_cache_get(key):
+    with _guest_cache_lock:
+        if key not in _GUEST_CACHE:
+            return None
+        _GUEST_CACHE.move_to_end(key)
+        result = _GUEST_CACHE[key]
+    # Copia: quien llama puede modificar los dicts devueltos
+    return copy.deepcopy(result)
+
+def _guest_cache_put(key, structured_guests):
+    with _guest_cache_lock:
+        _GUEST_CACHE[key] = copy.deepcopy(structured_guests)
+        _GUEST_CACHE.move_to_end(key)
+        if len(_GUEST_CACHE) > _GUEST_CACHE_MAX:
+            _GUEST_CACHE.popitem(last=False)
+
 def analyze_guests_with_ai(guest_list, category_info=None):
     """
     Usa OpenAI para extraer y estructurar la información de los invitados
@@ -1643,6 +2576,13 @@ def analyze_guests_with_ai(guest_list, category_info=None):
         
         # Convertir la lista de invitados a texto para el prompt
         guests_text = "\n".join(guest_list)
+
+        # Reenvíos del mismo lote (p. ej. por un corte de red) reutilizan la respuesta anterior
+        cache_key = _guest_cache_key(guests_text, category_info)
+        cached = _guest_cache_get(cache_key)
+        if cached is not None:
+            logger.info("Usando resultado de OpenAI en caché para esta lista de invitados")
+            return cached
         
         # Si hay información de categoría, incluirla en el prompt
         category_context = ""
@@ -1651,71 +2591,68 @@ def analyze_guests_with_ai(guest_list, category_info=None):
             for category, lines in category_info.items():
                 category_context += f"La categoría '{category}' incluye {len(lines)} invitados. "
         
-        prompt = f"""
-        A continuación hay una lista de invitados. {category_context}Por favor, extrae y estructura la información de cada invitado en formato JSON.
-        
-        Reglas importantes:
-        1. Cada línea o entrada debe corresponder exactamente a un invitado.
-        2. Cada invitado debe tener un nombre y un email asociado.
-        3. Si ves un guión o un separador entre el nombre y el email, úsalo para separarlos.
-        4. Si una línea incluye "Hombres:" o "Mujeres:", es un encabezado de categoría, no un invitado.
-        5. El género debe ser "Masculino" si está en la categoría "Hombres" y "Femenino" si está en "Mujeres".
-        
-        Para cada invitado, identifica estos campos:
-        - nombre: solo el primer nombre de la persona
-        - apellido: solo el apellido de la persona
-        - email: el email de la persona (debe haber exactamente un email por invitado)
-        - genero: "Masculino", "Femenino" u "Otro" basado en el contexto y nombre
-        
-        Lista de invitados:
-        {guests_text}
-        
-        Responde solo con un array JSON. Cada elemento del array debe corresponder a un invitado único con su email.
-        """
+        prompt = GUEST_EXTRACTION_PROMPT.format(category_context=category_context, guests_text=guests_text)
         
+        _openai_bucket.acquire()
         response = client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
-                {"role": "system", "content": "Eres un asistente especializado en extraer información estructurada de textos."},
+                {"role": "system", "content": GUEST_EXTRACTION_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            temperature=0,
+            seed=GUEST_EXTRACTION_SEED
         )
         
         # Obtener la respuesta como JSON
         result_text = response.choices[0].message.content
         logger.info(f"Respuesta IA para invitados: {result_text[:100]}...")
         
-        # Intentar parsear directamente
-        try:
-            structured_data = json.loads(result_text)
-            # Verificar si es un array o si tiene una propiedad que contiene el array
-            if isinstance(structured_data, list):
-                return structured_data
-            for key, value in structured_data.items():
-                if isinstance(value, list):
-                    return value
-        except Exception as e:
-            logger.error(f"Error al parsear JSON de OpenAI: {e}")
-        
-        # Buscar el array JSON dentro de la respuesta como fallback
-        if "{" in result_text and "[" in result_text:
-            array_match = re.search(r'\[(.*?)\]', result_text, re.DOTALL)
-            if array_match:
-                array_text = f"[{array_match.group(1)}]"
-                try:
-                    structured_guests = json.loads(array_text)
-                    return structured_guests
-                except:
-                    pass
-        
-        return None
+        structured_guests = _parse_guests_ai_response(result_text)
+        if structured_guests is not None:
+            _guest_cache_put(cache_key, structured_guests)
+        return structured_guests
         
     except Exception as e:
         logger.error(f"Error al analizar invitados con OpenAI: {e}")
         return None
 
+def _parse_guests_ai_response(result_text):
+    """Extrae la lista de invitados de la respuesta de OpenAI, o None si no hay."""
+    # Intentar parsear directamente
+    try:
+        structured_data = json.loads(result_text)
+        # Formato pedido en el prompt: {"guests": [...]}
+        if isinstance(structured_data, dict) and isinstance(structured_data.get("guests"), list):
+            return structured_data["guests"]
+        # Verificar si es un array o si tiene una propiedad que contiene el array
+        if isinstance(structured_data, list):
+            return structured_data
+        for key, value in structured_data.items():
+            if isinstance(value, list):
+                return value
+    except Exception as e:
+        logger.error(f"Error al parsear JSON de OpenAI: {e}")
+    
+    # Buscar el array JSON dentro de la respuesta como fallback
+    if "{" in result_text and "[" in result_text:
+        return _extract_json_array(result_text)
+    
+    return None
+
     
+class Guest(NamedTuple):
+    """
+    Invitado ya parseado (nombre, apellido, email, género e Instagram opcional).
+    Es una tupla inmutable: sin dict por instancia y se desempaqueta directo al armar la fila.
+    """
+    nombre: str
+    apellido: str = ''
+    email: str = ''
+    genero: Optional[str] = None
+    instagram: str = ''
+
 def extract_guests_from_split_format(lines):
     """
     Procesa el formato BLOQUES: Nombres primero, luego Emails, opcionalmente bajo categorías.
@@ -1727,8 +2664,7 @@ def extract_guests_from_split_format(lines):
 
     Returns:
         tuple: (list, dict) donde:
-            - list: Lista de diccionarios con info estructurada, o lista vacía si hay error grave.
-                   {'nombre': str, 'apellido': str, 'email': str, 'genero': str}
+            - list: Lista de Guest con info estructurada, o lista vacía si hay error grave.
             - dict: Información del error si ocurrió, o None si no hubo errores:
                    {'error_type': str, 'category': str, 'names_count': int, 'emails_count': int}
     """
@@ -1754,11 +2690,11 @@ def extract_guests_from_split_format(lines):
         potential_category_key = None
         
         # Patrones flexibles para categorías masculinas
-        if re.match(r'(?i)^(hombres?|varones?)[\s:]*$', line):
+        if SPLIT_MALE_HEADER_RE.match(line):
             potential_category_key = 'Hombres'
             is_category = True
         # Patrones flexibles para categorías femeninas
-        elif re.match(r'(?i)^(mujeres?|damas?)[\s:]*$', line):
+        elif SPLIT_FEMALE_HEADER_RE.match(line):
             potential_category_key = 'Mujeres'
             is_category = True
 
@@ -1783,7 +2719,7 @@ def extract_guests_from_split_format(lines):
         # --- Detectar Emails ---
         is_email = False
         # Regex más estricto para emails válidos
-        if re.match(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$", line):
+        if EMAIL_LINE_RE.match(line):
              is_email = True
 
         if is_email:
@@ -1807,7 +2743,7 @@ def extract_guests_from_split_format(lines):
                  parsing_mode = 'names'
 
              # Validar que parezca un nombre (letras y espacios) y no sea demasiado corto
-             if re.match(r"^[a-zA-ZáéíóúÁÉÍÓÚñÑüÜ\s']+$", line) and len(line) > 2:
+             if NAME_LINE_RE.match(line) and len(line) > 2:
                  if current_category_key in data_by_category:
                      data_by_category[current_category_key]['names'].append(line)
                      logger.debug(f"Nombre agregado a '{current_category_key}': {line}")
@@ -1863,6 +2799,10 @@ def extract_guests_from_split_format(lines):
         # Esta es una categoría válida
         at_least_one_valid_category = True
 
+        # Sin género por categoría: una sola consulta a OpenAI para todos los nombres de la categoría
+        if genero in ["Otro", None]:
+            infer_genders_llm(name.split()[0] for name in names if name.split())
+
         # Emparejar uno a uno
         for i in range(len(names)):
             full_name = names[i].strip()
@@ -1886,21 +2826,16 @@ def extract_guests_from_split_format(lines):
             # Si no hay género específico (categoría 'General' o similar) y tenemos nombre, usar IA
             if genero in ["Otro", None] and nombre:
                 inferred = infer_gender_llm(nombre)
-                if inferred.lower() in ['hombre', 'masculino']:
+                inferred_key = inferred.casefold()
+                if inferred_key in MALE_LABELS:
                     final_genero = "Masculino"
-                elif inferred.lower() in ['mujer', 'femenino']:
+                elif inferred_key in FEMALE_LABELS:
                     final_genero = "Femenino"
                 else:
                     final_genero = "Otro"  # Fallback si no se pudo determinar
                 logger.debug(f"Género inferido por IA para '{nombre}': {inferred} -> {final_genero}")
             
-            guest_info = {
-                "nombre": nombre,
-                "apellido": apellido,
-                "email": email,
-                "genero": final_genero
-            }
-            guests.append(guest_info)
+            guests.append(Guest(nombre, apellido, email, final_genero))
             logger.debug(f"Invitado emparejado OK: {full_name} - {email} ({genero})")
 
     # Verificar si se procesó al menos una categoría válida
@@ -1933,6 +2868,26 @@ def extract_guests_from_split_format(lines):
     logger.info(f"DEBUG PARSER OUTPUT: Estructura final devuelta por el parser: {guests}") # Imprime la lista completa
     return (guests, error_info)
 
+# Los comandos cortos (saludo, conteo, ayuda) se repiten mucho: su clasificación se memoiza.
+# Los mensajes largos (listas de invitados) casi nunca se repiten y no se guardan en la caché.
+SHORT_COMMAND_MAX_LEN = 64
+
+def _classify_command(msg_key):
+    """
+    Clasifica un mensaje normalizado (strip + lower) como 'saludo', 'count', 'help' o None
+    """
+    match = COMMAND_CLASSIFIER_RE.match(msg_key)
+    return match.lastgroup if match else None
+
+_classify_short_command = lru_cache(maxsize=1024)(_classify_command)
+
+def classify_command(message):
+    """ Devuelve el tipo de comando simple del mensaje, usando la caché solo para mensajes cortos """
+    msg_key = message.strip().lower()
+    if len(msg_key) <= SHORT_COMMAND_MAX_LEN:
+        return _classify_short_command(msg_key)
+    return _classify_command(msg_key)
+
 def parse_message(message):
     """
     Analiza el mensaje para identificar el comando, los datos y las categorías
@@ -1945,78 +2900,36 @@ def parse_message(message):
     """
     message = message.strip()
     
-    # Verificar si es un saludo simple
-    saludo_patterns = [
-        r'(?i)^hola$',
-        r'(?i)^buenos días$',
-        r'(?i)^buenas tardes$',
-        r'(?i)^buenas noches$',
-        r'(?i)^saludos$',
-        r'(?i)^hi$',
-        r'(?i)^hey$',
-        r'(?i)^hello$',
-        r'(?i)^ola$',
-        r'(?i)^buen día$'
-    ]
-    
-    
-    
-    # Verificar si es una consulta de conteo
-    count_patterns = [
-        r'(?i)cu[aá]ntos invitados',
-        r'(?i)contar invitados',
-        r'(?i)total de invitados',
-        r'(?i)invitados totales',
-        r'(?i)lista de invitados'
-    ]
-    
-    for pattern in count_patterns:
-        if re.search(pattern, message.lower()):
-            return {
-                'command_type': 'count',
-                'data': None,
-                'categories': None
-            }
-    
-    # Verificar si es una solicitud de ayuda
-    help_patterns = [
-        r'^ayuda$',
-        r'^help$',
-        r'c[oó]mo funciona',
-        r'c[oó]mo usar'
-    ]
-    
-    for pattern in help_patterns:
-        if re.search(pattern, message.lower()):
-            return {
-                'command_type': 'help',
-                'data': None,
-                'categories': None
-            }
+    # Verificar si es un saludo simple, una consulta de conteo o una solicitud de ayuda
+    command_type = classify_command(message)
+    if command_type:
+        return {
+            'command_type': command_type,
+            'data': None,
+            'categories': None
+        }
     
-    # Extraer invitados y categorías
-    lines = message.split('\n')
+    # Extraer invitados y categorías (una sola pasada, agregando a las listas en el lugar)
     valid_lines = []
     categories = {}
-    current_category = None
+    current_lines = None # Lista de la categoría actual dentro de `categories`
     
-    for line in lines:
+    for line in message.split('\n'):
         line = line.strip()
         if not line:
             continue
         
         # Verificar si es un encabezado de categoría
-        category_match = re.match(r'^(Hombres|Mujeres|Niños|Adultos|Familia)[\s:]*$', line, re.IGNORECASE)
+        category_match = CATEGORY_HEADER_RE.match(line)
         if category_match:
-            current_category = category_match.group(1).capitalize()
-            categories[current_category] = []
+            current_lines = categories[category_match.group(1).capitalize()] = []
             continue
         
         # Si no es un encabezado y tiene contenido, agregarlo como línea válida
-        if line and len(line) > 2:
+        if len(line) > 2:
             valid_lines.append(line)
-            if current_category:
-                categories[current_category] = categories.get(current_category, []) + [line]
+            if current_lines is not None:
+                current_lines.append(line)
     
     # Si no hay categorías pero hay líneas válidas, crear una categoría predeterminada
     if valid_lines and not categories:
@@ -2029,60 +2942,37 @@ def parse_message(message):
         'categories': categories if categories else None
     }
 
-def parse_message_enhanced(message):
+def parse_message_enhanced(message, command_type=None):
     """
     Versión simplificada que solo detecta comandos específicos (count/help)
     y trata todo lo demás como mensaje genérico
     
     Args:
         message (str): Mensaje del usuario
+        command_type (str, optional): Resultado de classify_command(message) si ya se calculó
         
     Returns:
         dict: Información sobre el comando, datos y categorías detectadas
     """
-    # Comprobar comandos específicos que deben ser tratados aparte
-    
-    # Verificar si es una consulta de conteo
-    count_patterns = [
-        r'(?i)cu[aá]ntos invitados',
-        r'(?i)contar invitados',
-        r'(?i)total de invitados',
-        r'(?i)invitados totales',
-        r'(?i)lista de invitados'
-    ]
-    
-    for pattern in count_patterns:
-        if re.search(pattern, message.lower()):
-            return {
-                'command_type': 'count',
-                'data': None,
-                'categories': None
-            }
-    
-    # Verificar si es una solicitud de ayuda
-    help_patterns = [
-        r'^ayuda$',
-        r'^help$',
-        r'c[oó]mo funciona',
-        r'c[oó]mo usar'
-    ]
-    
-    for pattern in help_patterns:
-        if re.search(pattern, message.lower()):
-            return {
-                'command_type': 'help',
-                'data': None,
-                'categories': None
-            }
+    message = message.strip()
+    # Comprobar comandos específicos que deben ser tratados aparte (count/help).
+    # Los saludos no se tratan aparte aquí: siguen como mensaje genérico.
+    if command_type is None:
+        command_type = classify_command(message)
+    if command_type in ('count', 'help'):
+        return {
+            'command_type': command_type,
+            'data': None,
+            'categories': None
+        }
     
     # Cualquier otro mensaje se trata como genérico para mostrar eventos
     # (incluidos saludos, texto aleatorio, emojis, etc.)
-    lines = message.strip().split('\n')
-    valid_lines = [line.strip() for line in lines if line.strip()]
+    valid_lines = [line for line in (raw.strip() for raw in message.split('\n')) if line]
     
     return {
         'command_type': 'generic_message',
-        'data': valid_lines if valid_lines else [message.strip()],
+        'data': valid_lines if valid_lines else [message],
         'categories': None
     }
 
@@ -2105,99 +2995,6 @@ def extract_guests_manually_enhanced(lines, categories=None, command_type='add_g
     # Para el formato original, usar la lógica existente
     return extract_guests_manually(lines, categories)
 
-# Modificación a la función add_guests_to_sheet para usar el nuevo extractor
-def add_guests_to_sheet(sheet, guests_data, phone_number, event_name, sheet_conn, categories=None, command_type='add_guests'):
-    """
-    Agrega invitados a la hoja con información estructurada, incluyendo el evento
-    y usando el nombre del PR en lugar del número en la columna 'Publica'.
-    """
-    try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # --- Log mejorado para depuración ---
-        logger.info(f"INICIO add_guests_to_sheet para evento '{event_name}' - Phone: {phone_number}")
-        logger.info(f"Verificando objeto sheet: {sheet} - Tipo: {type(sheet)}")
-        
-        # --- Verificar encabezados para 6 columnas ---
-        expected_headers = ['Nombre y Apellido', 'Email', 'Genero', 'Publica', 'Evento', 'Timestamp', "ENVIADO"]
-        try:
-            headers = sheet.row_values(1)
-            logger.info(f"Encabezados existentes: {headers}")
-        except gspread.exceptions.APIError as api_err:
-            logger.error(f"Error API al leer encabezados: {api_err}")
-            if "exceeds grid limits" in str(api_err):
-                headers = []
-                logger.info("Hoja detectada como vacía (sin encabezados)")
-            else:
-                raise api_err
-
-        # Actualizar si los encabezados no coinciden o la hoja está vacía
-        if not headers or len(headers) < len(expected_headers) or headers[:len(expected_headers)] != expected_headers:
-            logger.info(f"Actualizando/Creando encabezados en la hoja '{sheet.title}': {expected_headers}")
-            try:
-                # Expandir la hoja para tener suficientes columnas si es necesario
-                current_cols = sheet.col_count
-                if current_cols < len(expected_headers):
-                    sheet.add_cols(len(expected_headers) - current_cols)
-                sheet.update('A1:G1', [expected_headers])
-                logger.info("Encabezados actualizados correctamente")
-            except Exception as header_err:
-                logger.error(f"ERROR al actualizar encabezados: {header_err}")
-                # Continuar intento de añadir datos incluso si falla actualización de encabezados
-
-        # --- Procesar datos de invitados (resto del código original) ---
-        # ... (código original hasta crear rows_to_add)
-
-        # --- MEJORA: Log de las filas que se intentan añadir ---
-        if rows_to_add:
-            try:
-                logger.info(f"Intentando añadir {len(rows_to_add)} filas. Primera fila: {rows_to_add[0]}")
-                # Añadir a la hoja con manejo de errores más detallado
-                try:
-                    result = sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
-                    # Limpiar colores de fondo de las filas recién agregadas
-                    clear_background_color_for_new_rows(sheet, len(rows_to_add))
-                    logger.info(f"Resultado de append_rows: {result}")
-                    # Verificación adicional después de append
-                    try:
-                        all_values = sheet.get_all_values()
-                        logger.info(f"Después de append_rows, la hoja tiene {len(all_values)} filas")
-                        # Si hay menos de 3 filas, mostrar todo el contenido para debugging
-                        if len(all_values) < 3:
-                            logger.info(f"Contenido actual de la hoja: {all_values}")
-                    except Exception as verify_err:
-                        logger.error(f"Error al verificar contenido después de append: {verify_err}")
-                    
-                    logger.info(f"Agregados {len(rows_to_add)} invitados para evento '{event_name}' por {phone_number}")
-                    return len(rows_to_add)
-                except gspread.exceptions.APIError as api_err:
-                    logger.error(f"Error API DETALLADO al agregar filas: {api_err}")
-                    # Aquí puedes agregar más manejo específico según el tipo de error de API
-                    if "insufficient permissions" in str(api_err).lower():
-                        logger.critical("ERROR DE PERMISOS: La cuenta de servicio no tiene permisos de escritura")
-                    elif "invalid value" in str(api_err).lower():
-                        logger.error(f"ERROR DE VALOR: Posible formato incorrecto en los datos: {rows_to_add[0]}")
-                    return 0
-                except Exception as append_err:
-                    logger.error(f"Error inesperado en append_rows: {append_err}")
-                    import traceback
-                    logger.error(traceback.format_exc())
-                    return 0
-            except Exception as pre_append_err:
-                logger.error(f"Error antes de llamar a append_rows: {pre_append_err}")
-                import traceback
-                logger.error(traceback.format_exc())
-                return 0
-        else:
-            logger.warning("No se generaron filas válidas para añadir a la hoja.")
-            return 0
-
-    except Exception as e:
-        logger.error(f"Error GRANDE en add_guests_to_sheet: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        return 0
-
 def extract_guests_manually(lines, categories=None):
     """
     Procesa manualmente las líneas de invitados cuando IA no está disponible
@@ -2209,23 +3006,88 @@ def extract_guests_manually(lines, categories=None):
     Returns:
         list: Lista de diccionarios con información estructurada de invitados
     """
-    guests = []
-    
     if categories:
         # Procesar por categorías
-        for category, category_lines in categories.items():
-            for line in category_lines:
-                guest_info = extract_guest_info_from_line(line, category)
-                if guest_info["nombre"]:  # Solo agregar si hay al menos un nombre
-                    guests.append(guest_info)
+        parsed = (extract_guest_info_from_line(line, category)
+                  for category, category_lines in categories.items()
+                  for line in category_lines)
     else:
         # Procesar todas las líneas sin categorías
-        for line in lines:
-            guest_info = extract_guest_info_from_line(line)
-            if guest_info["nombre"]:  # Solo agregar si hay al menos un nombre
-                guests.append(guest_info)
-    
-    return guests
+        parsed = (extract_guest_info_from_line(line) for line in lines)
+
+    # Solo agregar si hay al menos un nombre
+    return [guest_info for guest_info in parsed if guest_info["nombre"]]
+
+# Nombres frecuentes cuyo género no sigue la regla de terminación en 'a'/'o'
+GENDER_NAME_OVERRIDES = {
+    "luca": "Masculino", "bautista": "Masculino", "nicola": "Masculino",
+    "rosario": "Femenino", "consuelo": "Femenino", "amparo": "Femenino", "socorro": "Femenino",
+    "carmen": "Femenino", "isabel": "Femenino", "raquel": "Femenino", "inés": "Femenino",
+    "beatriz": "Femenino", "luz": "Femenino", "sol": "Femenino", "pilar": "Femenino",
+    "mercedes": "Femenino", "dolores": "Femenino", "abigail": "Femenino",
+}
+# Regla por terminación: una sola búsqueda en dict con la última letra del nombre
+GENDER_BY_LAST_LETTER = {"a": "Femenino", "o": "Masculino"}
+
+# Detector offline de género por nombre (gender-guesser), opcional. Los nombres que conoce no
+# pasan por OpenAI en infer_gender_llm / infer_genders_llm
+GENDER_GUESSER_AVAILABLE = False
+try:
+    import gender_guesser.detector as gender_detector
+    GENDER_GUESSER_AVAILABLE = True
+except ImportError:
+    logger.warning("Módulo gender-guesser no está instalado. Los géneros se inferirán con OpenAI o por la terminación del nombre.")
+
+GENDER_GUESSER_MAP = {
+    "male": "Masculino", "mostly_male": "Masculino",
+    "female": "Femenino", "mostly_female": "Femenino",
+}
+# Mismo género con las etiquetas que devuelven infer_gender_llm / infer_genders_llm
+GENDER_LABEL_TO_LLM = {"Masculino": "Hombre", "Femenino": "Mujer"}
+
+@lru_cache(maxsize=1)
+def _get_gender_detector():
+    """ Crea el detector en el primer uso (carga el diccionario de nombres una sola vez) """
+    return gender_detector.Detector(case_sensitive=False)
+
+def _guess_gender_offline(nombre):
+    """
+    Género por nombre de pila sin llamadas de red: excepciones conocidas y luego gender-guesser
+    (si está instalado). Devuelve "Masculino", "Femenino" o None si no conoce el nombre
+    """
+    nombre_low = nombre.strip().casefold()
+    override = GENDER_NAME_OVERRIDES.get(nombre_low)
+    if override:
+        return override
+    if GENDER_GUESSER_AVAILABLE and nombre_low:
+        return GENDER_GUESSER_MAP.get(_get_gender_detector().get_gender(nombre_low))
+    return None
+
+def _infer_gender(nombre):
+    """
+    Infiere el género a partir del nombre de pila: excepciones conocidas, luego gender-guesser
+    y, si no conoce el nombre, la terminación a/o
+    """
+    guessed = _guess_gender_offline(nombre)
+    if guessed:
+        return guessed
+    # 'ia'/'io' ya terminan en 'a'/'o': alcanza con mirar la última letra
+    return GENDER_BY_LAST_LETTER.get(nombre.casefold()[-1:], "Otro")
+
+def _fill_name_around_email(guest_info, line):
+    """
+    Busca el email en la línea con una sola pasada y usa el resto (lo que queda antes y
+    después del match) como nombre y apellido.
+    """
+    email_match = LOOSE_EMAIL_RE.search(line)
+    if not email_match:
+        return
+    guest_info["email"] = email_match.group(0)
+    name_parts = (line[:email_match.start()] + line[email_match.end():]).split()
+    if name_parts:
+        guest_info["nombre"] = name_parts[0]
+        if len(name_parts) > 1:
+            guest_info["apellido"] = " ".join(name_parts[1:])
 
 def extract_guest_info_from_line(line, category=None):
     """
@@ -2250,72 +3112,37 @@ def extract_guest_info_from_line(line, category=None):
     if not line or len(line.strip()) < 3:
         return guest_info
     
-    # Detectar si hay un separador entre nombre y email
-    separator = None
-    if " - " in line:
-        separator = " - "
-    elif "-" in line:
-        separator = "-"
-    elif ":" in line:
-        separator = ":"
-    
-    # Extraer nombre y email según el separador
-    if separator:
-        parts = line.split(separator, 1)
-        if len(parts) == 2:
-            name_part = parts[0].strip()
-            email_part = parts[1].strip()
-            
+    # Separador entre nombre y email, en orden de prioridad: partition hace una sola pasada por
+    # candidato y ya devuelve las dos partes (" - " va primero para no cortar nombres compuestos)
+    for separator in GUEST_LINE_SEPARATORS:
+        name_part, found, email_part = line.partition(separator)
+        if found:
             # Asignar email si parece válido (tiene @ y un punto después)
-            if "@" in email_part and "." in email_part.split("@")[1]:
+            email_part = email_part.strip()
+            if AT_DOT_RE.match(email_part):
                 guest_info["email"] = email_part
-            
+
             # Procesar nombre y apellido
             name_parts = name_part.split()
             if name_parts:
                 guest_info["nombre"] = name_parts[0]
                 if len(name_parts) > 1:
                     guest_info["apellido"] = " ".join(name_parts[1:])
-        else:
-            # Si no hay dos partes, intentar detectar el email directamente
-            if "@" in line and "." in line.split("@")[1]:
-                email_match = re.search(r'\S+@\S+\.\S+', line)
-                if email_match:
-                    guest_info["email"] = email_match.group(0)
-                    # Quitar el email de la línea para extraer el nombre
-                    name_part = line.replace(guest_info["email"], "").strip()
-                    name_parts = name_part.split()
-                    if name_parts:
-                        guest_info["nombre"] = name_parts[0]
-                        if len(name_parts) > 1:
-                            guest_info["apellido"] = " ".join(name_parts[1:])
+            break
     else:
         # Si no hay separador, intentar extraer email directamente
-        if "@" in line and "." in line.split("@")[1]:
-            email_match = re.search(r'\S+@\S+\.\S+', line)
-            if email_match:
-                guest_info["email"] = email_match.group(0)
-                # Quitar el email de la línea para extraer el nombre
-                name_part = line.replace(guest_info["email"], "").strip()
-                name_parts = name_part.split()
-                if name_parts:
-                    guest_info["nombre"] = name_parts[0]
-                    if len(name_parts) > 1:
-                        guest_info["apellido"] = " ".join(name_parts[1:])
+        _fill_name_around_email(guest_info, line)
     
     # Si hay información de categoría, usarla para determinar el género
     if category:
-        if category.lower() in ["hombre", "hombres", "masculino"]:
+        category_key = category.casefold()
+        if category_key in MALE_CATEGORY_LABELS:
             guest_info["genero"] = "Masculino"
-        elif category.lower() in ["mujer", "mujeres", "femenino"]:
+        elif category_key in FEMALE_CATEGORY_LABELS:
             guest_info["genero"] = "Femenino"
     else:
         # Intentar determinar el género a partir del nombre
-        nombre = guest_info["nombre"].lower()
-        if nombre.endswith("a") or nombre.endswith("ia"):
-            guest_info["genero"] = "Femenino"
-        elif nombre.endswith("o") or nombre.endswith("io"):
-            guest_info["genero"] = "Masculino"
+        guest_info["genero"] = _infer_gender(guest_info["nombre"])
     
     return guest_info
 
@@ -2343,7 +3170,8 @@ def add_guests_to_sheet(sheet, guests_data, phone_number, event_name, sheet_conn
         # --- AJUSTADO: Verificar encabezados para 6 columnas ---
         expected_headers = ['Nombre y Apellido', 'Email', 'Genero', 'Publica', 'Evento', 'Timestamp', "ENVIADO"]
         try:
-            headers = sheet.row_values(1)
+            # Encabezados desde la caché de la conexión: sin row_values(1) en cada alta
+            headers = sheet_conn.get_headers(sheet)
         except gspread.exceptions.APIError as api_err:
              if "exceeds grid limits" in str(api_err): # Hoja completamente vacía
                 headers = []
@@ -2361,13 +3189,15 @@ def add_guests_to_sheet(sheet, guests_data, phone_number, event_name, sheet_conn
                 sheet.add_cols(len(expected_headers) - current_cols)
             # Actualizar el rango correcto A1:G1 para 7 columnas
             sheet.update('A1:G1', [expected_headers])
+            sheet_conn.set_cached_headers(sheet, expected_headers)
 
 
         # --- Procesar datos de invitados ---
         structured_guests = None
 
-        # Usar IA si está disponible y NO es formato split (OpenAI no está entrenado para el formato split)
-        if command_type == 'add_guests' and OPENAI_AVAILABLE and client:
+        # Usar IA si está disponible y NO es formato split (OpenAI no está entrenado para el formato split).
+        # Sin ningún '@' no hay invitados válidos posibles: se evita la llamada a OpenAI
+        if command_type == 'add_guests' and OPENAI_AVAILABLE and client and any('@' in line for line in guests_data):
             logger.info("Intentando análisis de invitados con OpenAI...")
             structured_guests = analyze_guests_with_ai(guests_data, categories)
             if structured_guests:
@@ -2390,25 +3220,20 @@ def add_guests_to_sheet(sheet, guests_data, phone_number, event_name, sheet_conn
             return 0 # Indicar que no se añadió nada
 
         # --- Validar invitados estructurados ---
-        valid_guests = []
-        invalid_entries_found = False
+        # Cualquier entrada inválida rechaza toda la lista: se corta en la primera y, si no hay
+        # ninguna, se usa la misma lista sin copiarla. El isinstance sigue haciendo falta porque
+        # la respuesta de OpenAI puede traer elementos que no son dicts.
         for guest in structured_guests:
             # Verificar que sea diccionario y tenga email y al menos nombre
-            if isinstance(guest, dict) and guest.get("email") and guest.get("nombre"):
-                # Validar email básico
-                if re.match(r"[^@]+@[^@]+\.[^@]+", guest["email"]):
-                    valid_guests.append(guest)
-                else:
-                    logger.warning(f"Formato de email inválido: {guest.get('email')} para {guest.get('nombre')}")
-                    invalid_entries_found = True
-            else:
+            if not (isinstance(guest, dict) and guest.get("email") and guest.get("nombre")):
                 logger.warning(f"Invitado incompleto (falta email o nombre): {guest}")
-                invalid_entries_found = True
-
-        # Si se encontraron entradas inválidas, devolver error de validación
-        if invalid_entries_found:
+            elif not BASIC_EMAIL_RE.match(guest["email"]):
+                logger.warning(f"Formato de email inválido: {guest.get('email')} para {guest.get('nombre')}")
+            else:
+                continue
             logger.error("Se detectaron invitados sin email válido o nombre.")
             return -1  # Código especial para indicar error de validación
+        valid_guests = structured_guests
         
         # --- NUEVO: Obtener Nombre del PR ---
         pr_name = phone_number # Valor por defecto si no se encuentra el mapeo o el número
@@ -2427,25 +3252,27 @@ def add_guests_to_sheet(sheet, guests_data, phone_number, event_name, sheet_conn
             # pr_name ya tiene el número como fallback
 
         # --- Crear filas para añadir a la hoja (MODIFICADO) ---
-        rows_to_add = []
-        for guest in valid_guests:
-            full_name = f"{guest.get('nombre', '')} {guest.get('apellido', '')}".strip()
-            rows_to_add.append([
-                full_name,                      # Columna A: Nombre y Apellido
-                guest.get("email", ""),         # Columna B: Email
+        # nombre y email ya se validaron: acceso directo. apellido/genero pueden faltar en dicts de OpenAI
+        rows_to_add = [
+            [
+                f"{guest['nombre']} {guest.get('apellido', '')}".strip(),  # Columna A: Nombre y Apellido
+                guest["email"],                 # Columna B: Email
                 guest.get("genero", "Otro"),    # Columna C: Genero
-                pr_name,                        # Columna D: Publica (Nombre del PR o número fallback) <--- MODIFICADO
+                pr_name,                        # Columna D: Publica (Nombre del PR o número fallback)
                 event_name,                     # Columna E: Evento
                 timestamp,                      # Columna F: Timestamp
                 False                           # Columna G: ENVIADO (casilla de verificación)
-            ])
+            ]
+            for guest in valid_guests
+        ]
 
         # --- Agregar a la hoja ---
         if rows_to_add:
             try:
-                sheet.append_rows(rows_to_add, value_input_option='USER_ENTERED')
-                # Limpiar colores de fondo de las filas recién agregadas
-                clear_background_color_for_new_rows(sheet, len(rows_to_add))
+                # La cola agrupa esta escritura con las de otras solicitudes concurrentes,
+                # reintenta ante 429 y limpia el color de fondo de las filas nuevas
+                sheets_write_queue.write_rows(sheet, rows_to_add)
+                sheet_conn.invalidate_records(sheet)
                 logger.info(f"Agregados {len(rows_to_add)} invitados para evento '{event_name}' por {phone_number}")
                 return len(rows_to_add)
             except gspread.exceptions.APIError as e:
@@ -2480,7 +3307,7 @@ def parse_vip_guest_list_with_instagram(message_body):
         
     Returns:
         tuple: (list, dict) donde:
-            - list: Lista de diccionarios con info estructurada [{'nombre': n, 'apellido': a, 'email': e, 'instagram': i, 'genero': g}, ...]
+            - list: Lista de Guest con info estructurada (nombre, apellido, email, instagram, genero)
             - dict: Información del error si ocurrió, o None si no hubo errores
     """
     guests = []
@@ -2507,11 +3334,11 @@ def parse_vip_guest_list_with_instagram(message_body):
         potential_category_key = None
         
         # Patrones flexibles para categorías masculinas
-        if re.match(r'^hombres?\s*:?\s*$', line, re.IGNORECASE):
+        if VIP_MALE_HEADER_RE.match(line):
             potential_category_key = "Hombres"
             is_category = True
         # Patrones flexibles para categorías femeninas  
-        elif re.match(r'^mujeres?\s*:?\s*$', line, re.IGNORECASE):
+        elif VIP_FEMALE_HEADER_RE.match(line):
             potential_category_key = "Mujeres"
             is_category = True
         
@@ -2525,7 +3352,8 @@ def parse_vip_guest_list_with_instagram(message_body):
             continue
 
         # --- Detectar Emails ---
-        is_email = '@' in line and '.' in line.split('@')[-1] and len(line.split('@')[0]) > 0
+        # '@' que no inicia la línea y un '.' después del último '@', sin crear listas con split
+        is_email = line.find('@') > 0 and line.rfind('.') > line.rfind('@')
         
         if is_email and parsing_mode in ['names', 'emails']:
             parsing_mode = 'emails'
@@ -2536,8 +3364,7 @@ def parse_vip_guest_list_with_instagram(message_body):
                     data_by_category[current_category_key] = {'names': [], 'emails': [], 'instagrams': []}
             
             # Buscar múltiples emails en la línea usando regex
-            email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
-            found_emails = re.findall(email_pattern, line)
+            found_emails = EMAIL_FIND_RE.findall(line)
             
             if found_emails:
                 # Añadir todos los emails encontrados en orden
@@ -2546,7 +3373,7 @@ def parse_vip_guest_list_with_instagram(message_body):
                 logger.debug(f"Emails encontrados en línea: {found_emails}")
             else:
                 # Fallback: usar el método anterior para emails que no pasen el regex más estricto
-                if re.match(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$", line):
+                if EMAIL_LINE_RE.match(line):
                     data_by_category[current_category_key]['emails'].append(line)
             continue
 
@@ -2575,7 +3402,7 @@ def parse_vip_guest_list_with_instagram(message_body):
                     data_by_category[current_category_key] = {'names': [], 'emails': [], 'instagrams': []}
             
             # Validar que parece un nombre válido
-            if re.match(r"^[a-zA-ZáéíóúÁÉÍÓÚñÑüÜ\s'.]+$", line) and len(line) > 1:
+            if VIP_NAME_LINE_RE.match(line) and len(line) > 1:
                 data_by_category[current_category_key]['names'].append(line)
             continue
 
@@ -2597,6 +3424,10 @@ def parse_vip_guest_list_with_instagram(message_body):
             logger.error(f"Desbalance en categoría '{category_key}': {len(names)} nombres, {len(emails)} emails, {len(instagrams)} instagrams")
             return [], error_info
         
+        # Categoría sin género (Default): una sola consulta a OpenAI para todos sus nombres
+        if category_map.get(category_key) is None and category_key == "Default":
+            infer_genders_llm(name.split()[0] for name in names if name.split())
+        
         # Crear invitados
         for i in range(len(names)):
             name_parts = names[i].split()
@@ -2609,22 +3440,16 @@ def parse_vip_guest_list_with_instagram(message_body):
             # Si no hay categoría específica (Default) o no se pudo mapear, usar IA
             if genero is None and category_key == "Default" and nombre:
                 inferred = infer_gender_llm(nombre)
-                if inferred.lower() in ['hombre', 'masculino']:
+                inferred_key = inferred.casefold()
+                if inferred_key in MALE_LABELS:
                     genero = "Masculino"
-                elif inferred.lower() in ['mujer', 'femenino']:
+                elif inferred_key in FEMALE_LABELS:
                     genero = "Femenino"
                 else:
                     genero = None  # Mantener como None si no se pudo determinar
                 logger.debug(f"Género inferido por IA para '{nombre}': {inferred} -> {genero}")
             
-            guest = {
-                'nombre': nombre,
-                'apellido': apellido,
-                'email': emails[i],
-                'instagram': instagrams[i],
-                'genero': genero
-            }
-            guests.append(guest)
+            guests.append(Guest(nombre, apellido, emails[i], genero, instagrams[i]))
     
     if not guests and lines:  # Si había líneas pero no se procesaron invitados
         error_info = {'error_type': 'no_valid_pairs'}
@@ -2684,19 +3509,20 @@ def parse_vip_guest_list(message_body):
             continue # Saltar la línea del encabezado
 
         # Detectar Emails
-        is_email = '@' in line and '.' in line.split('@')[-1] and len(line.split('@')[0]) > 0
+        # '@' que no inicia la línea y un '.' después del último '@', sin crear listas con split
+        is_email = line.find('@') > 0 and line.rfind('.') > line.rfind('@')
         if is_email:
             if parsing_names:
                 # Si es el primer email que encontramos, cambiamos a modo email
                 parsing_names = False
             
-            if re.match(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$", line):
+            if EMAIL_LINE_RE.match(line):
                 categories[current_category]['emails'].append(line)
             else:
                 logger.warning(f"parse_vip_guest_list: Línea '{line}' parece email pero no valida regex.")
         elif parsing_names:
             # Añadir nombre si parece un nombre válido
-            if re.match(r"^[a-zA-ZáéíóúÁÉÍÓÚñÑüÜ\s'.]+$", line) and len(line) > 1:
+            if VIP_NAME_LINE_RE.match(line) and len(line) > 1:
                 categories[current_category]['names'].append({'nombre': line, 'genero': current_category if current_category != 'default' else None})
             else:
                 logger.warning(f"parse_vip_guest_list: Línea '{line}' ignorada (modo nombre).")
@@ -2771,9 +3597,10 @@ def parse_vip_guest_list(message_body):
                 # Si no hay género específico y tenemos nombre, usar IA
                 if genero is None and nombre:
                     inferred = infer_gender_llm(nombre)
-                    if inferred.lower() in ['hombre', 'masculino']:
+                    inferred_key = inferred.casefold()
+                    if inferred_key in MALE_LABELS:
                         genero = "Masculino"
-                    elif inferred.lower() in ['mujer', 'femenino']:
+                    elif inferred_key in FEMALE_LABELS:
                         genero = "Femenino"
                     else:
                         genero = None  # Mantener None si no se pudo determinar
@@ -2829,17 +3656,14 @@ def get_guests_by_pr(sheet_conn, phone_number):
                     logger.warning(f"No se pudo acceder a la hoja del evento '{event_name}'.")
                     continue
 
-                # Obtener todos los registros de la hoja
-                all_guests = event_sheet.get_all_records()
-                if not all_guests:
+                # Valores de la hoja desde la caché de TTL corto (sin armar un dict por fila)
+                if not sheet_conn.count_records(event_sheet):
                     # Si la hoja está vacía (solo tiene encabezados)
                     logger.info(f"Hoja '{event_name}' no tiene invitados registrados.")
                     continue
 
-                # Filtrar por nombre del PR o número de teléfono (como fallback)
-                event_guests = [guest for guest in all_guests if 
-                               guest.get('PR') == pr_name or 
-                               guest.get('PR') == phone_number]
+                # Filtrar por nombre del PR o número de teléfono (como fallback) usando el índice por PR
+                event_guests = sheet_conn.get_records_by_pr(event_sheet, pr_name, phone_number)
                 
                 if event_guests:
                     guests_by_event[event_name] = event_guests
@@ -2857,6 +3681,14 @@ def get_guests_by_pr(sheet_conn, phone_number):
         logger.error(traceback.format_exc())
         return {}
 
+# Columnas candidatas para nombre y email en los registros de invitados, en orden de prioridad
+NAME_COLUMNS = ('Nombre y Apellido', 'Nombre', 'nombre')
+EMAIL_COLUMNS = ('Email', 'email')
+
+def _pick_columns(headers, candidates):
+    """ Devuelve las columnas candidatas presentes en los encabezados (o claves de un registro), en orden """
+    return tuple(col for col in candidates if col in headers)
+
 def generate_per_event_response(guests_by_event, pr_name, phone_number):
     """
     Genera una respuesta detallada agrupada por evento.
@@ -2881,19 +3713,20 @@ def generate_per_event_response(guests_by_event, pr_name, phone_number):
 
         response_parts.append(f"\n\n--- Evento: *{event_name}* ---")
 
-        # Calcular conteos por género para ESTE evento
-        event_categories = {}
+        # Todas las filas del evento vienen de la misma hoja: columnas resueltas una vez
+        name_cols = _pick_columns(event_guest_list[0], NAME_COLUMNS)
+        email_cols = _pick_columns(event_guest_list[0], EMAIL_COLUMNS)
+
+        # Agrupar por la columna TIPO en una sola pasada; el conteo de cada tipo es el largo del grupo
+        guests_by_gender_in_event = defaultdict(list)
         for guest in event_guest_list:
-            # Usar directamente el valor de la columna TIPO
-            tipo = guest.get('TIPO', 'Sin categoría')
-            event_categories[tipo] = event_categories.get(tipo, 0) + 1
+            guests_by_gender_in_event[guest.get('TIPO', 'Sin categoría')].append(guest)
 
         # Añadir conteos por género para el evento
         has_gender_counts = False
-        for category, count in event_categories.items():
-             if count > 0:
-                response_parts.append(f"📊 {category}: {count}")
-                has_gender_counts = True
+        for category, guests in guests_by_gender_in_event.items():
+            response_parts.append(f"📊 {category}: {len(guests)}")
+            has_gender_counts = True
         if not has_gender_counts:
              response_parts.append("(No se especificó género)")
 
@@ -2905,25 +3738,15 @@ def generate_per_event_response(guests_by_event, pr_name, phone_number):
 
         # Añadir detalle de invitados para el evento
         response_parts.append("\n📝 Detalle:")
-        guests_by_gender_in_event = {}
-        for guest in event_guest_list:
-            # Usar directamente el valor de la columna TIPO
-            tipo = guest.get('TIPO', 'Sin categoría')
-            if tipo not in guests_by_gender_in_event:
-                guests_by_gender_in_event[tipo] = []
-            guests_by_gender_in_event[tipo].append(guest)
-
         for tipo, guests in guests_by_gender_in_event.items():
             response_parts.append(f"*{tipo}*:")
             for guest in guests:
-                name_keys = ['Nombre y Apellido', 'Nombre', 'nombre']
-                email_keys = ['Email', 'email']
-                full_name = next((guest[k] for k in name_keys if k in guest and guest[k]), '').strip()
+                full_name = next((guest[k] for k in name_cols if guest.get(k)), '').strip()
                 if not full_name:
                      nombre = guest.get('nombre', '')
                      apellido = guest.get('apellido', '')
                      full_name = f"{nombre} {apellido}".strip() or "?(sin nombre)"
-                email = next((guest[k] for k in email_keys if k in guest and guest[k]), '?(sin email)')
+                email = next((guest[k] for k in email_cols if guest.get(k)), '?(sin email)')
                 
                 # Obtener el estado de 'Enviado' (casilla de verificación)
                 logger.info(f"DEBUG SUMMARY: Claves disponibles en guest: {list(guest.keys())}")
@@ -2972,65 +3795,54 @@ def generate_count_response(result, guests_data, phone_number, sentiment, event_
  
     # Mensaje si no hay invitados
     if not result or result.get('Total', 0) == 0:
-        if event_name:
-            base_response = f"{header_intro} ({phone_number}):\n\n-- Ninguno --"
-        else:
-             base_response = f"{header_intro} ({phone_number}):\n\n-- Ninguno --"
-        # Añadir instrucciones si no hay invitados
-        base_response += "\n\n(Puedes añadir invitados seleccionando un evento y enviando la lista)."
-        return base_response # Salir temprano si no hay invitados
+        # Añadir instrucciones si no hay invitados; salir temprano
+        return (f"{header_intro} ({phone_number}):\n\n-- Ninguno --"
+                "\n\n(Puedes añadir invitados seleccionando un evento y enviando la lista).")
 
-    # Construir respuesta si SÍ hay invitados
-    base_response = f"{header_intro} ({phone_number}):\n\n"
+    # Construir respuesta si SÍ hay invitados: se acumulan partes y se unen una sola vez al final
+    parts = [f"{header_intro} ({phone_number}):\n\n"]
 
     # Mostrar conteo por género (excluyendo 'Total')
     has_gender_counts = False
     for category, count in result.items():
         if category != 'Total' and count > 0:
-            display_category = category
-            if category.lower() == "masculino":
-                display_category = "Hombres"
-            elif category.lower() == "femenino":
-                display_category = "Mujeres"
+            display_category = GENDER_DISPLAY_NAMES.get(category.casefold(), category)
             # Añadir emoji o formato
-            base_response += f"📊 {display_category}: {count}\n"
+            parts.append(f"📊 {display_category}: {count}\n")
             has_gender_counts = True
 
     if not has_gender_counts: # Si solo había 'Total' > 0 pero no géneros específicos
-         base_response += "(No se especificó género para los invitados)\n"
+         parts.append("(No se especificó género para los invitados)\n")
 
 
     # Mostrar Total
-    base_response += f"\nTotal: {result.get('Total', 0)} invitados\n\n"
+    parts.append(f"\nTotal: {result.get('Total', 0)} invitados\n\n")
 
     # Añadir detalle si hay datos
     if guests_data:
-        base_response += "📝 Detalle de invitados:\n"
+        parts.append("📝 Detalle de invitados:\n")
+        # Los registros de get_all_records comparten encabezados: columnas resueltas una vez
+        name_cols = _pick_columns(guests_data[0], NAME_COLUMNS)
+        email_cols = _pick_columns(guests_data[0], EMAIL_COLUMNS)
         # Agrupar invitados por género (usando los datos ya filtrados)
-        guests_by_gender = {}
+        guests_by_gender = defaultdict(list)
         for guest in guests_data:
             # Usar directamente el valor de la columna TIPO
-            tipo = guest.get('TIPO', 'Sin categoría')
-
-            if tipo not in guests_by_gender:
-                guests_by_gender[tipo] = []
-            guests_by_gender[tipo].append(guest)
+            guests_by_gender[guest.get('TIPO', 'Sin categoría')].append(guest)
 
         # Mostrar invitados por tipo
         for tipo, guests in guests_by_gender.items():
-            base_response += f"\n*{tipo}*:\n"
+            parts.append(f"\n*{tipo}*:\n")
             for guest in guests:
                 # Intentar obtener nombre/apellido/email de forma flexible
-                name_keys = ['Nombre y Apellido', 'Nombre', 'nombre']
-                email_keys = ['Email', 'email']
-                full_name = next((guest[k] for k in name_keys if k in guest and guest[k]), '').strip()
+                full_name = next((guest[k] for k in name_cols if guest.get(k)), '').strip()
                 # Si no encontramos 'Nombre y Apellido', intentar construirlo
                 if not full_name:
                      nombre = guest.get('nombre', '')
                      apellido = guest.get('apellido', '')
                      full_name = f"{nombre} {apellido}".strip()
 
-                email = next((guest[k] for k in email_keys if k in guest and guest[k]), '?(sin email)')
+                email = next((guest[k] for k in email_cols if guest.get(k)), '?(sin email)')
                 
                 # Obtener el estado de 'Enviado' (casilla de verificación)
                 logger.info(f"DEBUG: Claves disponibles en guest: {list(guest.keys())}")
@@ -3047,17 +3859,74 @@ def generate_count_response(result, guests_data, phone_number, sentiment, event_
                     enviado_status = f'❓ {enviado}'
 
                 logger.info(f"DEBUG: Estado final para {full_name}: {enviado_status}")
-                base_response += f"  • {full_name} - {email} ({enviado_status})\n"
+                parts.append(f"  • {full_name} - {email} ({enviado_status})\n")
 
     # Personalizar según sentimiento (opcional, se puede quitar si no es necesario)
     if sentiment == "positivo":
-        return f"{base_response}\n¡Gracias por tu interés!"
+        parts.append("\n¡Gracias por tu interés!")
     elif sentiment == "negativo":
-        return f"{base_response}\n¿Hay algo específico en lo que pueda ayudarte?"
-    else:
-        return base_response
-    return base_response # Devolver la respuesta base sin personalización de sentimiento por ahora
+        parts.append("\n¿Hay algo específico en lo que pueda ayudarte?")
+    return "".join(parts)
     
+# AQUÍ ES DONDE SE DEFINE EL MENSAJE DE BIENVENIDA
+WELCOME_TEXT = """👋 ¡Hola! Bienvenido al sistema de gestión de invitados. 
+
+Puedo ayudarte con la administración de tu lista de invitados. Aquí tienes lo que puedes hacer:
+
+1️⃣ *Agregar invitados*: 
+   Envía los datos en cualquiera de estos formatos:
+   • Juan Pérez - juan@ejemplo.com
+   • O por categorías:
+     Hombres:
+     Juan Pérez - juan@ejemplo.com
+     Mujeres:
+     María López - maria@ejemplo.com
+
+2️⃣ *Consultar invitados*:
+   • Escribe "cuántos invitados" o "lista de invitados"
+
+3️⃣ *Ayuda*:
+   • Escribe "ayuda" para ver estas instrucciones de nuevo
+
+¿En qué puedo ayudarte hoy?"""
+
+def _response_saludo(result, phone_number, sentiment, urgency):
+    """ Respuesta para saludo/ayuda: mensaje de bienvenida con instrucciones """
+    return WELCOME_TEXT
+
+def _response_count(result, phone_number, sentiment, urgency):
+    """ Respuesta para 'count': result es (conteos, invitados) o solo el dict de conteos """
+    counts, guests = result if isinstance(result, tuple) else (result, [])
+    return generate_count_response(counts, guests, phone_number, sentiment)
+
+def _response_add_guests(result, phone_number, sentiment, urgency):
+    """ Respuesta para 'add_guests': result es la cantidad agregada (-1 si hubo datos inválidos) """
+    if result == -1:
+        return "⚠️ No pude anotar los invitados: hay datos inválidos (ej. email o nombre faltante) en tu lista. Revisa el formato e intenta de nuevo."
+    if result and result > 0:
+        return f"✅ ¡Éxito! Se anotaron *{result}* invitado(s)."
+    return "❌ Hubo un error al guardar los invitados en la hoja. Por favor, intenta de nuevo más tarde."
+
+def _response_fallback(result, phone_number, sentiment, urgency):
+    """ Respuesta genérica para comandos sin manejador, ajustada al sentimiento """
+    if sentiment == "negativo":
+        response = "Lamento el inconveniente. ¿Hay algo específico en lo que pueda ayudarte?"
+    elif sentiment == "positivo":
+        response = "¡Gracias por tu mensaje! ¿En qué más puedo ayudarte?"
+    else:
+        response = "No entendí tu solicitud. Escribe \"ayuda\" para ver las opciones disponibles."
+    if urgency == "alta":
+        response += " Atenderemos tu consulta lo antes posible."
+    return response
+
+# Tabla de despacho comando -> manejador (una búsqueda en dict en lugar de cadena if/elif)
+RESPONSE_HANDLERS = {
+    'saludo': _response_saludo,
+    'help': _response_saludo,
+    'count': _response_count,
+    'add_guests': _response_add_guests,
+}
+
 def generate_response(command, result, phone_number=None, sentiment_analysis=None):
     """
     Genera respuestas personalizadas basadas en el comando, resultado y análisis de sentimiento
@@ -3080,43 +3949,14 @@ def generate_response(command, result, phone_number=None, sentiment_analysis=Non
         }
     
     sentiment = sentiment_analysis.get("sentiment", "neutral")
-    intent = sentiment_analysis.get("intent", "otro")
     urgency = sentiment_analysis.get("urgency", "media")
     
-    # Para comandos específicos, mantener la lógica original pero añadir personalización
-    if command == 'saludo':
-        # AQUÍ ES DONDE SE DEFINE EL MENSAJE DE BIENVENIDA
-        welcome_text = """👋 ¡Hola! Bienvenido al sistema de gestión de invitados. 
-
-Puedo ayudarte con la administración de tu lista de invitados. Aquí tienes lo que puedes hacer:
-
-1️⃣ *Agregar invitados*: 
-   Envía los datos en cualquiera de estos formatos:
-   • Juan Pérez - juan@ejemplo.com
-   • O por categorías:
-     Hombres:
-     Juan Pérez - juan@ejemplo.com
-     Mujeres:
-     María López - maria@ejemplo.com
-
-2️⃣ *Consultar invitados*:
-   • Escribe "cuántos invitados" o "lista de invitados"
-
-3️⃣ *Ayuda*:
-   • Escribe "ayuda" para ver estas instrucciones de nuevo
-
-¿En qué puedo ayudarte hoy?"""
-        
-        return welcome_text
-        
-    elif command == 'count':
-    
     # Normalizar el comando para add_guests
-        if command == 'add_guests_split':
-            command = 'add_guests'
-        
-    # Usar la función original
-    return generate_response(command, result, phone_number, sentiment_analysis)
+    if command == 'add_guests_split':
+        command = 'add_guests'
+    
+    handler = RESPONSE_HANDLERS.get(command, _response_fallback)
+    return handler(result, phone_number, sentiment, urgency)
 
 @app.route('/test_sheet', methods=['GET'])
 def test_sheet_write():
@@ -3384,20 +4224,23 @@ def update_qr_sent_status(sheet_conn, processed_guests, status=True):
 # --- Función whatsapp_reply COMPLETA con Lógica VIP ---
 @app.route('/whatsapp', methods=['POST'])
 def whatsapp_reply():
-    global user_states
-    response_text = None
+    """
+    Webhook de Twilio: valida el remitente y procesa el mensaje en el pool del webhook.
+    Si termina dentro de WEBHOOK_TWIML_DEADLINE la respuesta va como TwiML en el cuerpo;
+    si no, el worker la envía por la API REST de Twilio al terminar.
+    """
     sender_phone_raw = None
     sender_phone_normalized = None
     sheet_conn = None
-    is_vip = False # Variable para saber si el usuario es VIP
-    error_info_parsing = None # Inicializar aquí para usar en STATE_AWAITING_GUEST_DATA
+    message_sid = None
 
 
     try:
-        data = request.form.to_dict()
-        # logger.info(f"Datos recibidos (crudos): {data}") # Demasiado detallado, loggear solo lo necesario
-        sender_phone_raw = data.get('From')
-        incoming_msg = data.get('Body', '').strip()
+        # Leer directamente del formulario (MultiDict) sin copiarlo a un dict intermedio
+        form_data = request.form
+        # logger.info(f"Datos recibidos (crudos): {form_data}") # Demasiado detallado, loggear solo lo necesario
+        sender_phone_raw = form_data.get('From')
+        incoming_msg = form_data.get('Body', '').strip()
         # incoming_msg_lower = incoming_msg.lower() # Opcional: usar versión lower si hay muchos checks case-insensitive
 
 
@@ -3407,7 +4250,7 @@ def whatsapp_reply():
             return jsonify({"status": "ignored", "message": "Empty message or invalid payload"}), 200 # Retornar 200 OK for empty messages
 
 
-        sender_phone_normalized = re.sub(r'\D', '', sender_phone_raw) # Normalizar número (quitar 'whatsapp:', '+', etc.)
+        sender_phone_normalized = normalize_phone(sender_phone_raw) # Normalizar número (quitar 'whatsapp:', '+', etc.)
         sheet_conn = SheetsConnection() # Obtener instancia
 
         # --- Validación de número autorizado GENERAL ---
@@ -3437,6 +4280,73 @@ def whatsapp_reply():
         logger.info(f"Mensaje recibido de número AUTORIZADO: {sender_phone_raw} ({sender_phone_normalized})")
         # --- Fin Validación General ---
 
+        # Reintento de Twilio de un mensaje ya recibido: no tocar user_states ni volver a responder
+        message_sid = form_data.get('MessageSid')
+        if message_sid and not _mark_message_seen(message_sid):
+            logger.info(f"MessageSid {message_sid} de {sender_phone_normalized} ya procesado. Ignorando reintento.")
+            return jsonify({"status": "ignored", "message": "Duplicate MessageSid"}), 200
+
+        # Procesar en el pool del webhook y esperar hasta WEBHOOK_TWIML_DEADLINE: si termina a tiempo
+        # la respuesta se devuelve como TwiML; si no, el worker la envía por REST al terminar
+        collector = TwimlReplyCollector(sender_phone_raw)
+        future = _enqueue_user_message(sender_phone_normalized,
+                                       partial(_process_whatsapp_message_serialized,
+                                               sender_phone_raw, sender_phone_normalized, incoming_msg,
+                                               sheet_conn, collector))
+        try:
+            future.result(timeout=WEBHOOK_TWIML_DEADLINE)
+        except FutureTimeoutError:
+            logger.info(f"Procesamiento de {sender_phone_normalized} sigue en segundo plano; respuesta por REST")
+        except Exception as process_err:
+            logger.error(f"Error procesando mensaje de {sender_phone_normalized}: {process_err}")
+        replies = collector.close()
+        return collector.to_twiml(replies), 200, {'Content-Type': 'text/xml'}
+
+    except Exception as e:
+        # Captura errores generales e inesperados en el flujo principal
+        logger.error(f"!!! Error INESPERADO Y GRAVE en el webhook para {sender_phone_raw or '???'}: {e} !!!")
+        logger.error(traceback.format_exc())
+        # Se devuelve 500 y Twilio reintentará: ese reintento no debe descartarse como duplicado
+        if message_sid:
+            _forget_message_sid(message_sid)
+        # Intentar notificar al usuario si es posible
+        if sender_phone_raw:
+            error_message = "Lo siento, ocurrió un error inesperado en el sistema. Por favor, intenta de nuevo más tarde."
+            send_twilio_message(sender_phone_raw, error_message) # Intentar enviar, puede fallar también
+        # Devolver error 500 al webhook (Twilio reintentará)
+        return jsonify({"status": "error", "message": "Internal server error"}), 500
+
+
+def _process_whatsapp_message_serialized(sender_phone_raw, sender_phone_normalized, incoming_msg, sheet_conn,
+                                         collector=None):
+    """
+    Procesa un mensaje desde la cola del usuario (de a uno y en orden, para no pisar su estado en user_states).
+    Con collector, las respuestas al remitente se juntan para devolverlas como TwiML.
+    """
+    _twiml_local.collector = collector
+    try:
+        status = _process_whatsapp_message(sender_phone_raw, sender_phone_normalized, incoming_msg, sheet_conn)
+    finally:
+        _twiml_local.collector = None
+        # Si el webhook ya respondió, lo que quedó en el colector se envía por REST
+        if collector is not None:
+            for message in collector.finish():
+                _send_twilio_rest(sender_phone_raw, message)
+    logger.info(f"Mensaje de {sender_phone_normalized} procesado: {status}")
+
+def _process_whatsapp_message(sender_phone_raw, sender_phone_normalized, incoming_msg, sheet_conn):
+    """
+    Lógica principal del bot (máquina de estados) para un mensaje ya validado.
+
+    Returns:
+        str: Estado del procesamiento ('success', 'processed_with_send_error', ...)
+    """
+    global user_states
+    response_text = None
+    is_vip = False # Variable para saber si el usuario es VIP
+    error_info_parsing = None # Inicializar aquí para usar en STATE_AWAITING_GUEST_DATA
+
+    try:
         # --- Chequeo VIP ---
         try:
             # Asegúrate que get_vip_phones devuelva un set o None
@@ -3470,19 +4380,9 @@ def whatsapp_reply():
         # ====================================
         
         # Verificar si es una consulta de conteo (funciona en cualquier estado)
-        count_patterns = [
-            r'cu[aá]ntos invitados',
-            r'contar invitados',
-            r'total de invitados',
-            r'invitados totales',
-            r'lista de invitados'
-        ]
-        
-        is_count_command = False
-        for pattern in count_patterns:
-            if re.search(pattern, incoming_msg.lower()):
-                is_count_command = True
-                break
+        # Clasificación única del mensaje (memoizada para mensajes cortos); se reutiliza en STATE_INITIAL
+        simple_command = classify_command(incoming_msg)
+        is_count_command = simple_command == 'count'
         
         if is_count_command:
             logger.info(f"Comando 'count' detectado en estado {current_state}.")
@@ -3510,30 +4410,17 @@ def whatsapp_reply():
             if response_text:
                 if not send_twilio_message(sender_phone_raw, response_text):
                     logger.error(f"Fallo al enviar mensaje de respuesta de conteo a {sender_phone_raw}")
-                    return jsonify({"status": "processed_with_send_error"}), 200
+                    return "processed_with_send_error"
                 else:
                     logger.info(f"Respuesta de conteo enviada a {sender_phone_raw}")
-                    return jsonify({"status": "success"}), 200
+                    return "success"
 
         # ====================================
         # --- Verificar comando QR (solo números especiales) ---
         # ====================================
         
         # Verificar si es un comando QR
-        qr_patterns = [
-            r'(?i)^enviar\s+qr',
-            r'(?i)^enviar\s+qrs?',
-            r'(?i)^send\s+qr',
-            r'(?i)^qr\s+send',
-            r'(?i)^procesar\s+qr',
-            r'(?i)^mandar\s+qr'
-        ]
-        
-        is_qr_command = False
-        for pattern in qr_patterns:
-            if re.search(pattern, incoming_msg.strip()):
-                is_qr_command = True
-                break
+        is_qr_command = QR_COMMAND_RE.search(incoming_msg.strip()) is not None
         
         if is_qr_command:
             logger.info(f"Comando QR detectado en estado {current_state} desde {sender_phone_normalized}.")
@@ -3547,7 +4434,7 @@ def whatsapp_reply():
                     
 Solo los números especiales configurados pueden usar esta función. Si necesitas acceso, contacta al administrador."""
                     send_twilio_message(sender_phone_raw, response_text)
-                    return jsonify({"status": "success"}), 200
+                    return "success"
                 
                 logger.info(f"Número especial QR confirmado: {sender_phone_normalized}")
                 
@@ -3559,7 +4446,7 @@ Solo los números especiales configurados pueden usar esta función. Si necesita
                     
 Los códigos QR solo se envían a invitados que ya tienen la invitación marcada como "Enviado: ✅" pero aún no han recibido su QR."""
                     send_twilio_message(sender_phone_raw, response_text)
-                    return jsonify({"status": "success"}), 200
+                    return "success"
                 
                 # Confirmar y procesar
                 total_pending = len(pending_guests)
@@ -3637,7 +4524,7 @@ Contacta al administrador."""
                 thread.daemon = True
                 thread.start()
                 
-                return jsonify({"status": "success"}), 200
+                return "success"
                 
             except Exception as qr_err:
                 logger.error(f"Error procesando comando QR para {sender_phone_normalized}: {qr_err}")
@@ -3645,7 +4532,7 @@ Contacta al administrador."""
 
 Por favor intenta nuevamente en unos minutos."""
                 send_twilio_message(sender_phone_raw, response_text)
-                return jsonify({"status": "success"}), 200
+                return "success"
 
         # ====================================
         # --- Lógica Principal de Estados ---
@@ -3655,7 +4542,7 @@ Por favor intenta nuevamente en unos minutos."""
         # desencadena la lista de eventos.
         if current_state == STATE_INITIAL:
             logger.info(f"Procesando mensaje en STATE_INITIAL para {sender_phone_normalized}")
-            parsed_command = parse_message_enhanced(incoming_msg)
+            parsed_command = parse_message_enhanced(incoming_msg, simple_command)
             command_type = parsed_command['command_type']
             logger.info(f"Comando parseado en INITIAL: '{command_type}'")
 
@@ -3745,7 +4632,7 @@ Ante cualquier duda, falla o feedback comunicate con Anto: wa.me/5491164855744
                  response_text = "Hubo un problema, no recuerdo los eventos. Por favor, envía cualquier mensaje para empezar de nuevo."
                  user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []}
              # Permitir "cancelar" en este estado
-             elif incoming_msg.lower() in ["cancelar", "salir", "cancel", "exit"]:
+             elif incoming_msg.lower() in CANCEL_COMMANDS:
                  logger.info(f"Usuario {sender_phone_normalized} canceló la selección de evento.")
                  response_text = "Selección cancelada. Puedes enviar cualquier mensaje para ver los eventos disponibles de nuevo."
                  user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []} # Resetear
@@ -3786,7 +4673,7 @@ Ante cualquier duda, falla o feedback comunicate con Anto: wa.me/5491164855744
                  response_text = "Hubo un problema, no recuerdo el evento. Por favor, envía cualquier mensaje para empezar de nuevo."
                  user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []}
              # Permitir "cancelar" en este estado
-             elif incoming_msg.lower() in ["cancelar", "salir", "cancel", "exit"]:
+             elif incoming_msg.lower() in CANCEL_COMMANDS:
                  logger.info(f"Usuario {sender_phone_normalized} canceló la selección de tipo de invitado para {selected_event}.")
                  response_text = f"Selección de tipo cancelada para el evento *{selected_event}*. Puedes enviar cualquier mensaje para empezar de nuevo."
                  user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []} # Resetear
@@ -3860,7 +4747,7 @@ Ante cualquier duda, falla o feedback comunicate con Anto: wa.me/5491164855744
                  response_text = "Hubo un problema interno, no sé qué evento o tipo procesar. Por favor, envía cualquier mensaje para empezar de nuevo."
                  user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []} # Resetear
              # Manejar "cancelar" en este estado
-             elif incoming_msg.lower() in ["cancelar", "salir", "cancel", "exit"]:
+             elif incoming_msg.lower() in CANCEL_COMMANDS:
                  logger.info(f"Usuario {sender_phone_normalized} canceló la adición de invitados para {selected_event}.")
                  response_text = f"Operación de añadir invitados cancelada para el evento *{selected_event}*. Puedes enviar cualquier mensaje para elegir otro evento o gestionar uno diferente."
                  user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []} # Resetear
@@ -3884,7 +4771,7 @@ Si necesitas agregar invitados después del envío automático, contacta al admi
 Puedes elegir otro evento enviando cualquier mensaje."""
                           user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []}
                           send_twilio_message(sender_phone_raw, response_text)
-                          return jsonify({"status": "success"}), 200
+                          return "success"
                       
                       elif event_qr_sent and is_special_number:
                           # El evento ya tuvo envío automático pero este es un número especial
@@ -3916,7 +4803,7 @@ Puedes elegir otro evento enviando cualquier mensaje."""
                                                 f"• {error_info_parsing.get('emails_count', 'N/A')} emails\n"
                                                 f"• {error_info_parsing.get('instagrams_count', 'N/A')} links de instagram\n\n"
                                                 f"La cantidad debe ser la misma para nombres, emails e instagram *en cada categoría con datos*. Revisa tu lista e intenta de nuevo o 'cancelar'.")
-                          elif error_info_parsing and error_info_parsing.get('error_type') in ['no_valid_categories', 'empty_message', 'incomplete_category', 'no_valid_pairs']:
+                          elif error_info_parsing and error_info_parsing.get('error_type') in FORMAT_ERROR_TYPES:
                                response_text = ("⚠️ No pude encontrar nombres, emails e Instagram válidos en el formato esperado (Nombres -> Emails -> Instagram separados por líneas vacías, opcionalmente por categorías).\n"
                                                 "Revisa el ejemplo e intenta de nuevo o escribe 'cancelar'.")
                           # Si no hubo un error_info_parsing específico pero la lista parseada estaba vacía, es un error de datos.
@@ -3952,13 +4839,13 @@ Puedes elegir otro evento enviando cualquier mensaje."""
                           
                           if unified_event_sheet:
                               # Usar la función unificada para guardar invitados VIP
-                              added_count = add_guests_to_unified_sheet(unified_event_sheet, structured_guests, pr_name, 'VIP', sheet_conn)
+                              added_count, duplicate_count = add_guests_to_unified_sheet(unified_event_sheet, structured_guests, pr_name, 'VIP', sheet_conn)
                           else:
                               logger.error(f"No se pudo crear/obtener hoja unificada para evento '{selected_event}'")
-                              added_count = 0
+                              added_count, duplicate_count = 0, 0
 
-                          if added_count > 0:
-                              response_text = f"✅ ¡Éxito! Se anotaron *{added_count}* invitado(s) VIP para el evento *{selected_event}*."
+                          if added_count >= 0 and (added_count or duplicate_count):
+                              response_text = unified_add_success_text(added_count, duplicate_count, "VIP", selected_event)
                               # Resetear estado después de éxito
                               user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []}
                           elif added_count == -1: # add_vip_guests_to_sheet devolvió -1 (hubo items pero todos inválidos)
@@ -4002,7 +4889,7 @@ Puedes elegir otro evento enviando cualquier mensaje."""
                                                      f"• {error_info_parsing.get('names_count', 'N/A')} nombres\n"
                                                      f"• {error_info_parsing.get('emails_count', 'N/A')} emails\n\n"
                                                      f"La cantidad debe ser la misma *en cada categoría con datos*. Revisa tu lista, separa nombres y emails con una línea vacía, e intenta de nuevo o 'cancelar'.")
-                               elif error_info_parsing and error_info_parsing.get('error_type') in ['no_valid_categories', 'empty_message', 'incomplete_category', 'no_valid_pairs']:
+                               elif error_info_parsing and error_info_parsing.get('error_type') in FORMAT_ERROR_TYPES:
                                     response_text = ("⚠️ No pude encontrar nombres y emails válidos en el formato esperado (Nombres -> Emails separados por línea vacía, opcionalmente por categorías).\n"
                                                      "Revisa el ejemplo e intenta de nuevo o escribe 'cancelar'.")
                                # Si no hubo un error_info_parsing específico pero la lista parseada estaba vacía, es un error de datos.
@@ -4035,11 +4922,11 @@ Puedes elegir otro evento enviando cualquier mensaje."""
                                     logger.error(f"Error al buscar PR Normal: {e}")
 
                                 # --- Usar función unificada para guardar invitados Normal ---
-                                added_count = add_guests_to_unified_sheet(unified_event_sheet, structured_guests, pr_name, 'Normal', sheet_conn)
+                                added_count, duplicate_count = add_guests_to_unified_sheet(unified_event_sheet, structured_guests, pr_name, 'Normal', sheet_conn)
 
                                 # --- Procesar resultado ---
-                                if added_count > 0:
-                                    response_text = f"✅ ¡Éxito! Se anotaron *{added_count}* invitado(s) Generales para el evento *{selected_event}*."
+                                if added_count >= 0 and (added_count or duplicate_count):
+                                    response_text = unified_add_success_text(added_count, duplicate_count, "Generales", selected_event)
                                     # Resetear estado después de éxito
                                     user_states[sender_phone_normalized] = {'state': STATE_INITIAL, 'event': None, 'guest_type': None, 'available_events': []}
                                 elif added_count == -1:
@@ -4073,10 +4960,10 @@ Puedes elegir otro evento enviando cualquier mensaje."""
             if not send_twilio_message(sender_phone_raw, response_text):
                 logger.error(f"Fallo al enviar mensaje de respuesta final a {sender_phone_raw}")
                 # OK para Twilio, pero loggeamos el error de envío
-                return jsonify({"status": "processed_with_send_error"}), 200
+                return "processed_with_send_error"
             else:
                 logger.info(f"Respuesta final enviada a {sender_phone_raw}: {response_text[:100]}...")
-                return jsonify({"status": "success"}), 200
+                return "success"
         else:
             # Si llegamos aquí sin response_text, algo falló en la lógica de estados
             # o una acción no generó respuesta (ej. parseo fallido sin mensaje de error)
@@ -4085,19 +4972,18 @@ Puedes elegir otro evento enviando cualquier mensaje."""
             # Enviar un mensaje genérico de fallback para que el usuario no quede esperando.
             fallback_message = "Lo siento, no pude procesar tu mensaje. Ocurrió un problema inesperado. Por favor, envía cualquier mensaje para intentar empezar de nuevo."
             send_twilio_message(sender_phone_raw, fallback_message)
-            return jsonify({"status": "processed_no_reply_generated"}), 200
+            return "processed_no_reply_generated"
 
 
     except Exception as e:
         # Captura errores generales e inesperados en el flujo principal
-        logger.error(f"!!! Error INESPERADO Y GRAVE en el webhook para {sender_phone_raw or '???'}: {e} !!!")
+        logger.error(f"!!! Error INESPERADO Y GRAVE al procesar el mensaje de {sender_phone_raw}: {e} !!!")
         logger.error(traceback.format_exc())
-        # Intentar notificar al usuario si es posible
-        if sender_phone_raw:
-            error_message = "Lo siento, ocurrió un error inesperado en el sistema. Por favor, intenta de nuevo más tarde."
-            send_twilio_message(sender_phone_raw, error_message) # Intentar enviar, puede fallar también
-        # Devolver error 500 al webhook (Twilio reintentará)
-        return jsonify({"status": "error", "message": "Internal server error"}), 500
+        # Intentar notificar al usuario
+        error_message = "Lo siento, ocurrió un error inesperado en el sistema. Por favor, intenta de nuevo más tarde."
+        send_twilio_message(sender_phone_raw, error_message) # Intentar enviar, puede fallar también
+        return "error"
+
 
 @app.route('/difusion', methods=['POST'])
 def broadcast_message():
@@ -4163,27 +5049,39 @@ def broadcast_message():
         
         def send_broadcast_async():
             results = {"sent": [], "failed": []}
-            current_phone = 0
-            
-            for phone in phone_numbers:
-                current_phone += 1
+            # Ritmo global: cada envío toma el siguiente turno libre, separados por send_interval
+            send_interval = 1.0 / BROADCAST_MAX_PER_SECOND if BROADCAST_MAX_PER_SECOND > 0 else 0.0
+            pacing_lock = threading.Lock()
+            next_send_at = [time.time()]
+
+            def send_one(phone):
+                with pacing_lock:
+                    now = time.time()
+                    send_at = max(now, next_send_at[0])
+                    next_send_at[0] = send_at + send_interval
+                if send_at > now:
+                    time.sleep(send_at - now)
                 try:
                     # Los números ya vienen normalizados de las funciones get_..._phones()
-                    result = send_templated_message(phone, template_sid, template_variables)
-                    if result.get("success"):
+                    return send_templated_message(phone, template_sid, template_variables), None
+                except Exception as e:
+                    return None, e
+
+            # Copia del set de la caché; map conserva su orden para el log de progreso
+            recipients = list(phone_numbers)
+            with ThreadPoolExecutor(max_workers=max(1, BROADCAST_CONCURRENCY), thread_name_prefix="broadcast") as pool:
+                for current_phone, (phone, (result, error)) in enumerate(
+                        zip(recipients, pool.map(send_one, recipients)), start=1):
+                    if error is not None:
+                        results["failed"].append({"phone": phone, "error": str(error)})
+                        logger.error(f"Error crítico al enviar a {phone}: {error}")
+                    elif result.get("success"):
                         results["sent"].append({"phone": phone, "sid": result.get("sid")})
                         logger.info(f"Mensaje enviado {current_phone}/{total_phones} a {phone}")
                     else:
                         results["failed"].append({"phone": phone, "error": result.get("error")})
                         logger.warning(f"Fallo al enviar {current_phone}/{total_phones} a {phone}: {result.get('error')}")
-                except Exception as e:
-                    results["failed"].append({"phone": phone, "error": str(e)})
-                    logger.error(f"Error crítico al enviar a {phone}: {e}")
-                
-                # Rate limiting: pausa de 1 segundo entre envíos (excepto el último)
-                if current_phone < total_phones:
-                    time.sleep(1)
-            
+
             total_sent = len(results["sent"])
             total_failed = len(results["failed"])
             logger.info(f"Difusión completada. Enviados: {total_sent}, Fallidos: {total_failed}")
@@ -4247,7 +5145,7 @@ def send_qrs():
         # Obtener invitados pendientes de QR
         if pr_phone:
             # Normalizar número de teléfono
-            pr_phone_normalized = re.sub(r'\D', '', pr_phone)
+            pr_phone_normalized = normalize_phone(pr_phone)
             logger.info(f"Procesando QRs para PR específico: {pr_phone_normalized}")
             pending_guests = get_pending_qr_guests_by_pr(sheet_conn, pr_phone_normalized, event_filter)
         else:
@@ -4335,4 +5233,30 @@ def send_qrs():
     except Exception as e:
         logger.error(f"Error CRÍTICO en el endpoint de QRs: {e}")
         logger.error(traceback.format_exc())
-        return jsonify({"status": "error", "message": "Ocurrió un error interno en el servidor."}), 500
\ No newline at end of file
+        return jsonify({"status": "error", "message": "Ocurrió un error interno en el servidor."}), 500
+
+# --- Precarga de la conexión a Google Sheets ---
+SHEETS_PREFETCH = os.environ.get('SHEETS_PREFETCH', '1') == '1'
+
+def _prefetch_sheets_loop():
+    """
+    Abre la conexión a Google Sheets al arrancar (antes del primer mensaje) y mantiene
+    calientes las cachés que usa el webhook, refrescándolas cuando vencen.
+    """
+    while True:
+        try:
+            sheet_conn = SheetsConnection()
+            sheet_conn.prefetch_metadata()
+            sheet_conn.get_vip_phones()
+            sheet_conn.get_phone_pr_mapping()
+            sheet_conn.get_vip_phone_pr_mapping()
+            sheet_conn.get_phone_pr_email_mapping()
+            sheet_conn.get_qr_special_phones()
+            sheet_conn.get_event_qr_states()
+            logger.info("Conexión y cachés de Google Sheets precargadas.")
+        except Exception as e:
+            logger.error(f"Error al precargar la conexión a Google Sheets: {e}")
+        time.sleep(SheetsConnection._phone_cache_interval)
+
+if SHEETS_PREFETCH:
+    threading.Thread(target=_prefetch_sheets_loop, name="sheets-prefetch", daemon=True).start()
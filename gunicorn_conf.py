@@ -0,0 +1,19 @@
+# Configuración de Gunicorn para producción
+#
+# Un solo proceso con varios hilos (gthread): user_states vive en la memoria del proceso,
+# así que con varios procesos los mensajes de un mismo usuario podrían caer en workers
+# distintos y perder el estado de la conversación. Con REDIS_URL el estado sobrevive reinicios, pero
+# sigue haciendo falta un solo proceso: la cola por usuario y la deduplicación por MessageSid
+# son por proceso. Los hilos permiten solapar las llamadas
+# de E/S a Google Sheets, Twilio y OpenAI, que dominan el tiempo de cada request.
+# No se usa gevent: la automatización de QR usa la API síncrona de Playwright, que no es
+# compatible con el monkey patching de gevent.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+worker_class = "gthread"
+threads = int(os.environ.get('GUNICORN_THREADS', '10'))  # Igual al --concurrency de Cloud Run
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
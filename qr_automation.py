@@ -5,6 +5,7 @@ Handles automated QR code generation and sending for guest lists
 
 import logging
 import os
+import re
 import time
 import pandas as pd
 from playwright.sync_api import sync_playwright, Playwright
@@ -17,6 +18,10 @@ import traceback
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Precompiled patterns (compiled once at import instead of on every call)
+TEST_TICKET_LABEL_RE = re.compile("TICKET PARA ENVIO DE PRUEBA")
+DIGITS_RE = re.compile(r'\d+')
+
 class PlanOutAutomation:
     """Handles automation tasks for PlanOut.ar QR generation and sending"""
     
@@ -848,7 +853,7 @@ class PlanOutAutomation:
                 # Method 2: Select by text (partial match)
                 lambda: self.page.select_option(price_dropdown, label="TICKET PARA ENVIO DE PRUEBA - $0"),
                 # Method 3: Select by partial text
-                lambda: self.page.locator(price_dropdown).select_option(label=re.compile("TICKET PARA ENVIO DE PRUEBA")),
+                lambda: self.page.locator(price_dropdown).select_option(label=TEST_TICKET_LABEL_RE),
                 # Method 4: Click dropdown and then click option
                 lambda: self._select_price_by_clicking(price_dropdown, "2623")
             ]
@@ -1471,8 +1476,7 @@ class PlanOutAutomation:
                         logger.info(f"Found stats content: {content}")
                         
                         # Simple parsing for numbers
-                        import re
-                        numbers = re.findall(r'\d+', content)
+                        numbers = DIGITS_RE.findall(content)
                         if len(numbers) >= 2:
                             stats["total_processed"] = int(numbers[0])
                             stats["successful_sends"] = int(numbers[1])
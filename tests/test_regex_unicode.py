@@ -0,0 +1,30 @@
+"""
+Los patrones que ven texto entre palabras deben tratar el NBSP como espacio, igual que re.
+Si alguno pasara a RE2 (\\s solo ASCII), los nombres con NBSP se descartarían sin aviso.
+"""
+import os
+
+import pytest
+
+# Importar sin conectar a Google Sheets ni escribir whatsapp_bot.log
+os.environ.setdefault('K_SERVICE', 'tests')
+os.environ.setdefault('SHEETS_PREFETCH', '0')
+
+import bot_whatsapp as bot
+
+
+@pytest.mark.parametrize("pattern, text", [
+    (bot.NAME_LINE_RE, "Juan\xa0Perez"),
+    (bot.VIP_NAME_LINE_RE, "Juan\xa0P.\xa0Perez"),
+    (bot.CATEGORY_HEADER_RE, "Mujeres\xa0:"),
+    (bot.SPLIT_MALE_HEADER_RE, "Hombres:\xa0"),
+    (bot.VIP_FEMALE_HEADER_RE, "Mujeres\xa0:"),
+])
+def test_nbsp_counts_as_space(pattern, text):
+    assert pattern.match(text)
+
+
+def test_loose_email_stops_at_nbsp():
+    email_match = bot.LOOSE_EMAIL_RE.search("Ana\xa0ana@b.com\xa0Paz")
+    assert email_match is not None
+    assert email_match.group(0) == "ana@b.com"